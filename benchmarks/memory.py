@@ -0,0 +1,109 @@
+"""
+Peak memory benchmark for HierarchyManager on large synthetic documents. Each mode is run in a fresh process, and
+peak resident set size is read from getrusage.
+
+Usage: python benchmarks/memory.py [size_mb] [mode ...]
+
+Modes are "default" (parse, apply_tags, create_output, then write) and "low_memory" (HierarchyManager.stream_output).
+"""
+
+import os
+import sys
+import time
+import random
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+HEADER_REGEX = ['Title [0-9]+', 'Chapter [0-9]+', 'Article [0-9]+\\.', '\\([a-z]\\)']
+WORDS = ['the', 'state', 'shall', 'law', 'council', 'provide', 'citizen', 'office', 'court', 'term', 'by', 'of']
+
+
+def make_document(path, size_mb, seed=0):
+    """
+    Write a synthetic document of roughly size_mb megabytes, with four header levels and occasional lists.
+    """
+
+    rng = random.Random(seed)
+    target = size_mb * 1024 * 1024
+    written = 0
+
+    def sentence():
+        return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(8, 30))).capitalize() + '.'
+
+    with open(path, 'wb') as f:
+        title = chapter = article = 0
+        while written < target:
+            lines = []
+            if article % 400 == 0:
+                title += 1
+                lines.append('Title {0} <title>{1}</title>'.format(title, sentence()))
+            if article % 40 == 0:
+                chapter += 1
+                lines.append('Chapter {0}'.format(chapter))
+
+            article += 1
+            lines.append('Article {0}. {1}'.format(article, sentence()))
+            for letter in 'abc'[:rng.randint(0, 3)]:
+                lines.append('({0}) {1}'.format(letter, sentence()))
+            if article % 25 == 0:
+                lines.append('<list>')
+                lines.extend(sentence() for _ in range(3))
+                lines.append('</list>')
+
+            chunk = '\n'.join(lines) + '\n'
+            f.write(chunk)
+            written += len(chunk)
+
+
+def run(text_path, mode):
+    from constitute_tools import parser
+    from constitute_tools import _file_utils as utils
+
+    out_path = text_path + '.' + mode + '.csv'
+    start = time.time()
+
+    if mode == 'low_memory':
+        manager = parser.HierarchyManager(text_path, HEADER_REGEX, low_memory=True)
+        manager.stream_output(out_path)
+    else:
+        manager = parser.HierarchyManager(text_path, HEADER_REGEX)
+        manager.parse()
+        manager.apply_tags()
+        with open(out_path, 'wb') as f:
+            utils.UnicodeWriter(f).writerows(manager.create_output())
+
+    elapsed = time.time() - start
+    os.remove(out_path)
+
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+
+    print('{0}\t{1:.1f}s\t{2:.1f} MB peak RSS'.format(mode, elapsed, peak / 1024.0))
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    modes = sys.argv[2:] or ['default', 'low_memory']
+
+    handle, text_path = tempfile.mkstemp(suffix='.txt')
+    os.close(handle)
+
+    try:
+        make_document(text_path, size_mb)
+        print('{0} MB synthetic document'.format(size_mb))
+        for mode in modes:
+            subprocess.check_call([sys.executable, __file__, '--run', text_path, mode])
+    finally:
+        os.remove(text_path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        run(sys.argv[2], sys.argv[3])
+    else:
+        main()
@@ -0,0 +1,61 @@
+"""
+Startup benchmark for short-lived worker processes. Measures the time to import constitute_tools.parser in fresh
+processes, checks it against a budget, and checks that deferred modules are not imported eagerly. The package is
+byte-compiled first, as it would be in an installed copy, so that timings do not include compiling the sources.
+
+Usage: python benchmarks/startup.py [budget_ms] [runs]
+"""
+
+import os
+import sys
+import compileall
+import subprocess
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+# modules that should only be imported once they are needed
+DEFERRED = ['inspect', 'tempfile', 'multiprocessing', 'json', 'hashlib', 'sqlite3']
+
+PROBE = '''
+import sys, time
+DEFERRED = ''' + repr(DEFERRED) + '''
+start = time.time()
+import constitute_tools.parser
+elapsed = (time.time() - start) * 1000
+print('%f %s' % (elapsed, ','.join(m for m in DEFERRED if m in sys.modules)))
+'''
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 15.0
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    compileall.compile_dir(os.path.join(PACKAGE_DIR, 'constitute_tools'), quiet=True)
+
+    timings = []
+    eager = set()
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', PROBE], cwd=PACKAGE_DIR).split()
+        timings.append(float(out[0]))
+        if len(out) > 1:
+            eager.update(out[1].split(','))
+
+    timings.sort()
+    median = timings[len(timings) // 2]
+
+    print('import constitute_tools.parser: median {0:.2f}ms, min {1:.2f}ms over {2} runs (budget {3:.1f}ms)'.format(
+        median, timings[0], runs, budget))
+
+    failed = False
+    if median > budget:
+        print('Startup budget exceeded.')
+        failed = True
+    if eager:
+        print('Deferred modules imported eagerly: ' + ', '.join(sorted(eager)))
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,122 @@
 import os
+import re
+import sys
 import csv
+import mmap
+import array
 import codecs
+import struct
 import cStringIO
+import unicodedata
+
+
+# format_header() results, keyed by raw header
+_header_cache = {}
+
+# characters that mark a reference as a pattern or a list rather than a single header, and label words ("Art") that
+# are dropped before checking that each reference component is a single alphanumeric run
+_reference_special = re.compile(r'[\[\]*+?{}|\\^$,]')
+_reference_label = re.compile(r'(?<!\w)[^\W\d_]{3,}(?!\w)', re.UNICODE)
+_reference_split = re.compile(r'[^\W_][\W_]+[^\W_]', re.UNICODE)
 
 
 class TagLoader:
     """
-    Helper function to load tags. Currently, only tags in the CCP format are implemented.
+    Helper function to load tags. Currently, only tags in the CCP format are implemented. Tag references are
+    normalized on load (see format_reference), with malformed references collected in self.malformed.
     """
     def __init__(self, tag_path, tag_format):
 
         self.tag_path = tag_path
         self.data = getattr(self, tag_format, None)()
+        self.references = {}
+        self.malformed = []
 
         if self.data is None:
             print('Tag path not found or invalid tag format, so tagging will not be conducted.')
+        else:
+            for tag_entry in self.data:
+                article = tag_entry['article']
+                if article not in self.references:
+                    self.references[article] = format_reference(article)
+                if self.references[article] is None:
+                    self.malformed.append(tag_entry)
+
+            if self.malformed:
+                print('{0} tags have malformed references and will not be matched: {1}'.format(
+                    len(self.malformed), ', '.join(sorted(set(repr(t['article']) for t in self.malformed)))))
 
     def ccp(self):
         tag_data = None
 
         if self.tag_path and os.path.exists(self.tag_path):
+            tag_data = []
+            seen = set()
+
+            # stream rows, keeping only the first instance of each (tag, article) pair
             with open(self.tag_path, 'rb') as f:
-                tag_data = list(csv.DictReader(f))
+                for tag_entry in csv.DictReader(f):
+                    pair = (tag_entry['tag'], tag_entry['article'])
+                    if pair not in seen:
+                        seen.add(pair)
+                        tag_data.append(tag_entry)
         return tag_data
 
 
+def format_header(h):
+    """
+    Helper function to strip sequences not used for matching from headers (e.g. "Title" or "Article"). Results are
+    cached, since the same headers recur within and across documents.
+    """
+    if h in _header_cache:
+        return _header_cache[h]
+
+    formatted = h.lower()
+    formatted = ''.join(e for e in formatted if unicodedata.category(e)[0] not in ['P', 'C'])
+
+    if formatted != 'preamble':
+        formatted = re.sub('[a-zA-Z]{3,}|\s+', '', formatted)
+
+    if len(_header_cache) > 100000:
+        _header_cache.clear()
+    _header_cache[h] = formatted
+
+    return formatted
+
+
+def format_reference(reference):
+    """
+    Normalize a tag reference (e.g. "75.1.a" or "1.1.1.(a)") with the same rules used by format_header, so that
+    references can be compared directly against header stubs. Punctuation is stripped from each component, as it is from
+    headers, but only around a component: a component whose alphanumeric runs are separated by punctuation or
+    whitespace (e.g. "3(2)" or "1 and 75"), or that contains pattern or list characters (e.g. "[1-3]" or "5, 6"), is
+    compound rather than a single header. Returns None if the reference is malformed (empty or compound components, or
+    nothing left after normalization).
+
+    :param reference: raw reference string, as given in the tag data.
+    """
+    if isinstance(reference, str):
+        reference = reference.decode('utf-8', 'replace')
+
+    reference = reference.strip()
+    if not reference:
+        return None
+
+    components = reference.split('.')
+    if not all(c.strip() for c in components):
+        return None
+
+    for c in components:
+        if _reference_special.search(c) or _reference_split.search(_reference_label.sub(' ', c).strip()):
+            return None
+
+    formatted = '.'.join(c for c in (format_header(c) for c in components) if c)
+    if not formatted:
+        return None
+
+    return formatted
+
+
 class TextLoader:
     """
     Helper function to load texts of unknown encoding. Loops through a few common encodings, and throws an error if
@@ -106,3 +198,183 @@ class UnicodeWriter:
     def writerows(self, rows):
         for row in rows:
             self.writerow(row)
+
+
+class ColumnarTable:
+    """
+    Compact columnar container for CCP-style output. Index and parent columns are kept as typed arrays, headers, text
+    types, and tags are interned into a shared string table, and row text is stored as offsets into a single UTF-8
+    blob. Tables are written in a little-endian binary layout readable through ColumnarReader.
+    """
+    magic = 'CCPC'
+    version = 1
+    # magic, version, row count, string count, tag count, blob length
+    header_format = '<4sIIIII'
+
+    def __init__(self, rows):
+        self.index = array.array('i')
+        self.parent = array.array('i')
+        self.header_ids = array.array('i')
+        self.type_ids = array.array('i')
+        self.text_offsets = array.array('I', [0])
+        self.tag_offsets = array.array('I', [0])
+        self.tag_ids = array.array('i')
+
+        self.strings = []
+        string_ids = {}
+
+        def intern(s):
+            if s not in string_ids:
+                string_ids[s] = len(self.strings)
+                self.strings.append(s)
+            return string_ids[s]
+
+        text_blob = []
+        blob_length = 0
+
+        for row in rows:
+            self.index.append(row[0])
+            self.parent.append(row[1])
+            self.header_ids.append(intern(_to_utf8(row[2])))
+            self.type_ids.append(intern(_to_utf8(row[4])))
+
+            text = _to_utf8(row[5])
+            text_blob.append(text)
+            blob_length += len(text)
+            self.text_offsets.append(blob_length)
+
+            for tag in row[6:]:
+                if tag:
+                    self.tag_ids.append(intern(_to_utf8(tag)))
+            self.tag_offsets.append(len(self.tag_ids))
+
+        self.text_blob = ''.join(text_blob)
+
+    def write(self, path):
+        """
+        Write the table to disk.
+
+        :param path: output path.
+        """
+        _check_column_types()
+
+        string_offsets = array.array('I', [0])
+        for s in self.strings:
+            string_offsets.append(string_offsets[-1] + len(s))
+
+        columns = [self.index, self.parent, self.header_ids, self.type_ids, self.text_offsets, self.tag_offsets,
+                   self.tag_ids, string_offsets]
+
+        with open(path, 'wb') as f:
+            f.write(struct.pack(self.header_format, self.magic, self.version, len(self.index), len(self.strings),
+                                len(self.tag_ids), len(self.text_blob)))
+            for column in columns:
+                if sys.byteorder != 'little':
+                    column = array.array(column.typecode, column)
+                    column.byteswap()
+                f.write(column.tostring())
+            f.write(''.join(self.strings))
+            f.write(self.text_blob)
+
+
+class ColumnarReader:
+    """
+    Memory-mapped reader for tables written by ColumnarTable. Columns and strings are read through buffers over the
+    mapped file, so loading a table does not require reparsing any text or copying the file into intermediate strings.
+    """
+    def __init__(self, path):
+        _check_column_types()
+
+        self.path = path
+
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, n_rows, n_strings, n_tags, blob_length = struct.unpack_from(ColumnarTable.header_format,
+                                                                                    self._map)
+        if magic != ColumnarTable.magic or version != ColumnarTable.version:
+            raise IOError('Not a recognized columnar CCP file: ' + path)
+
+        self.n_rows = n_rows
+
+        position = struct.calcsize(ColumnarTable.header_format)
+        self._columns = {}
+        for name, typecode, length in [('index', 'i', n_rows), ('parent', 'i', n_rows), ('header_ids', 'i', n_rows),
+                                       ('type_ids', 'i', n_rows), ('text_offsets', 'I', n_rows + 1),
+                                       ('tag_offsets', 'I', n_rows + 1), ('tag_ids', 'i', n_tags),
+                                       ('string_offsets', 'I', n_strings + 1)]:
+            self._columns[name] = (typecode, position, length)
+            position += length * array.array(typecode).itemsize
+
+        string_offsets = self.column('string_offsets')
+        self.strings = [self._decode(position + string_offsets[i], position + string_offsets[i+1])
+                        for i in range(n_strings)]
+        self._blob_start = position + string_offsets[-1]
+
+    def __len__(self):
+        return self.n_rows
+
+    def column(self, name):
+        """
+        Return a single column as a typed array.
+
+        :param name: one of index, parent, header_ids, type_ids, text_offsets, tag_offsets, tag_ids.
+        """
+        typecode, start, length = self._columns[name]
+        out = array.array(typecode)
+        out.fromstring(buffer(self._map, start, length * out.itemsize))
+
+        if sys.byteorder != 'little':
+            out.byteswap()
+
+        return out
+
+    def text(self, i):
+        """
+        Return the text of row i, decoded from the mapped text blob.
+        """
+        typecode, start, length = self._columns['text_offsets']
+        size = array.array(typecode).itemsize
+        text_start, text_end = struct.unpack_from('<' + 2*typecode, self._map, start + i*size)
+
+        return self._decode(self._blob_start + text_start, self._blob_start + text_end)
+
+    def rows(self):
+        """
+        Iterate over rows in the same column order as HierarchyManager.create_output('ccp'), with integer indices.
+        """
+        index = self.column('index')
+        parent = self.column('parent')
+        header_ids = self.column('header_ids')
+        type_ids = self.column('type_ids')
+        text_offsets = self.column('text_offsets')
+        tag_offsets = self.column('tag_offsets')
+        tag_ids = self.column('tag_ids')
+
+        for i in range(self.n_rows):
+            text = self._decode(self._blob_start + text_offsets[i], self._blob_start + text_offsets[i+1])
+            tags = [self.strings[t] for t in tag_ids[tag_offsets[i]:tag_offsets[i+1]]]
+
+            yield [index[i], parent[i], self.strings[header_ids[i]], '', self.strings[type_ids[i]], text] + tags
+
+    def _decode(self, start, end):
+        return unicode(buffer(self._map, start, end - start), 'utf-8')
+
+    def close(self):
+        self._map.close()
+
+
+def _check_column_types():
+    """
+    Check that the array types used for columns match the 4-byte integers of the columnar file layout.
+    """
+    for typecode in 'iI':
+        if array.array(typecode).itemsize != 4:
+            raise Exception('Columnar CCP files need 4-byte integer arrays, but array type {0!r} uses {1} bytes on '
+                            'this platform.'.format(typecode, array.array(typecode).itemsize))
+
+
+def _to_utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
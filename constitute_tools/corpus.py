@@ -0,0 +1,253 @@
+__author__ = 'rbshaffer'
+
+import ctypes
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+import parser
+import _file_utils as utils
+
+
+# corpus attached in the current worker process (see SharedCorpus.pool)
+_attached = None
+
+
+class SharedCorpus:
+    def __init__(self, documents=None, arrays=None):
+        """
+        Parse a corpus once and publish the parsed trees in shared memory, so that pool workers can run tag matching
+        without re-reading or re-parsing the documents. Each document is flattened (in document order) into a node
+        table of parent indices, header/text type/stub string IDs, and byte offsets into a shared UTF-8 text buffer.
+
+        :param documents: list of dictionaries of HierarchyManager keyword arguments (text_path, header_regex, and so
+            on), each with an optional 'name' (defaults to the file name).
+        :param arrays: shared arrays of an already published corpus. Used when attaching in a worker process.
+        """
+
+        if arrays is None:
+            arrays = self._publish(documents)
+
+        self.arrays = arrays
+        self.names = [self._string(i) for i in arrays['doc_name_ids']]
+
+        self._stub_cache = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def pool(self, processes=None):
+        """
+        Create a process pool whose workers attach to this corpus on startup. Shared arrays are handed to workers at
+        process creation, so nothing is copied or re-parsed per job. Jobs can then use attached() or match_tags().
+
+        :param processes: number of worker processes (defaults to the number of cores).
+        """
+
+        return multiprocessing.Pool(processes, initializer=_attach, initargs=(self.arrays,))
+
+    def nodes(self, doc):
+        """
+        Return the range of node indices belonging to a document.
+
+        :param doc: document index or name.
+        """
+
+        doc = self._doc_index(doc)
+        doc_offsets = self.arrays['doc_offsets']
+
+        return range(doc_offsets[doc], doc_offsets[doc + 1])
+
+    def node(self, i):
+        """
+        Return a single node as a dictionary, in the same form as entries in HierarchyManager.parsed (without
+        children). The parent index is global, with -1 for top-level entries.
+        """
+
+        arrays = self.arrays
+
+        return {'header': self._string(arrays['header_ids'][i]),
+                'text': self.text(i),
+                'text_type': self._string(arrays['type_ids'][i]),
+                'parent': arrays['parent'][i]}
+
+    def text(self, i):
+        """
+        Return the text of node i, decoded from the shared buffer.
+        """
+
+        text_offsets = self.arrays['text_offsets']
+
+        return self.arrays['text'][text_offsets[i]:text_offsets[i + 1]].decode('utf-8')
+
+    def stub_table(self, doc):
+        """
+        Build the header stub table for a document (see HierarchyManager.apply_tags), mapping joined header stubs to
+        node indices. Cached per process.
+
+        :param doc: document index or name.
+        """
+
+        doc = self._doc_index(doc)
+
+        if doc not in self._stub_cache:
+            parent = self.arrays['parent']
+            stub_ids = self.arrays['stub_ids']
+            type_ids = self.arrays['type_ids']
+            # 'body' is always interned first
+            body_id = 0
+
+            stub_table = {}
+            paths = {}
+
+            for i in self.nodes(doc):
+                stub = self._string(stub_ids[i])
+
+                if parent[i] < 0:
+                    paths[i] = [stub]
+                elif stub:
+                    paths[i] = paths[parent[i]] + [stub]
+                else:
+                    paths[i] = paths[parent[i]]
+
+                if type_ids[i] != body_id:
+                    stub_table['.'.join(h for h in paths[i] if h)] = i
+
+            self._stub_cache[doc] = stub_table, parser._index_stubs(stub_table)
+
+        return self._stub_cache[doc]
+
+    def match_tags(self, doc, tags):
+        """
+        Equivalent of HierarchyManager.apply_tags for a shared document. The shared trees are not modified; matches
+        are returned instead.
+
+        :param doc: document index or name.
+        :param tags: path to a CCP-style tag CSV, or a list of tag dictionaries with 'tag' and 'article' keys.
+        :return: (list of (tag entry, node index) pairs, list of unmatched or ambiguous tag entries)
+        """
+
+        if isinstance(tags, basestring):
+            tags = utils.TagLoader(tags, 'ccp').data or []
+
+        stub_table, stub_index = self.stub_table(doc)
+        references = {}
+
+        matched = []
+        tag_report = []
+
+        for tag_entry in tags:
+            article = tag_entry['article']
+            if article not in references:
+                references[article] = utils.format_reference(article)
+
+            matches = stub_index.get(references[article], []) if references[article] else []
+
+            if len(matches) == 1:
+                matched.append((tag_entry, stub_table[matches[0]]))
+            else:
+                tag_report.append(tag_entry)
+
+        return matched, tag_report
+
+    def _publish(self, documents):
+        """
+        Parse each document and copy the flattened node tables into shared arrays.
+        """
+
+        table = {'parent': [], 'header_ids': [], 'type_ids': [], 'stub_ids': [], 'text_offsets': [0],
+                 'doc_offsets': [0], 'doc_name_ids': []}
+        strings = []
+        string_ids = {}
+        text = []
+        text_length = [0]
+
+        def intern(s):
+            s = utils._to_utf8(s or '')
+            if s not in string_ids:
+                string_ids[s] = len(strings)
+                strings.append(s)
+            return string_ids[s]
+
+        def flatten(obj, parent_index):
+            for entry in obj:
+                node = len(table['parent'])
+
+                table['parent'].append(parent_index)
+                table['header_ids'].append(intern(entry['header']))
+                table['type_ids'].append(intern(entry['text_type']))
+                table['stub_ids'].append(intern(utils.format_header(entry['header'] or u'')))
+
+                entry_text = utils._to_utf8(entry['text'])
+                text.append(entry_text)
+                text_length[0] += len(entry_text)
+                table['text_offsets'].append(text_length[0])
+
+                if entry['children']:
+                    flatten(entry['children'], node)
+
+        intern('body')
+
+        for document in documents:
+            document = dict(document)
+            name = document.pop('name', None)
+
+            manager = parser.HierarchyManager(**document)
+            manager.parse()
+
+            flatten(manager.parsed, -1)
+            table['doc_offsets'].append(len(table['parent']))
+            table['doc_name_ids'].append(intern(name or manager.file_name))
+
+        string_offsets = [0]
+        for s in strings:
+            string_offsets.append(string_offsets[-1] + len(s))
+
+        arrays = dict((key, RawArray('i', values)) for key, values in table.items())
+        arrays['string_offsets'] = RawArray('i', string_offsets)
+        arrays['strings'] = _shared_bytes(''.join(strings))
+        arrays['text'] = _shared_bytes(''.join(text))
+
+        return arrays
+
+    def _string(self, i):
+        string_offsets = self.arrays['string_offsets']
+
+        return self.arrays['strings'][string_offsets[i]:string_offsets[i + 1]].decode('utf-8')
+
+    def _doc_index(self, doc):
+        if isinstance(doc, basestring):
+            return self.names.index(doc)
+        return doc
+
+
+def attached():
+    """
+    Return the corpus attached in the current worker process.
+    """
+
+    if _attached is None:
+        raise Exception('No corpus attached. Create worker pools with SharedCorpus.pool().')
+
+    return _attached
+
+
+def match_tags(job):
+    """
+    Pool-friendly wrapper for SharedCorpus.match_tags on the attached corpus.
+
+    :param job: (document index or name, tags) pair.
+    """
+
+    return attached().match_tags(*job)
+
+
+def _attach(arrays):
+    global _attached
+    _attached = SharedCorpus(arrays=arrays)
+
+
+def _shared_bytes(data):
+    buf = RawArray(ctypes.c_char, max(len(data), 1))
+    ctypes.memmove(buf, data, len(data))
+
+    return buf
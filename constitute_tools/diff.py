@@ -0,0 +1,292 @@
+__author__ = 'rbshaffer'
+
+import os
+import json
+import bisect
+import hashlib
+
+
+def fingerprint(parsed):
+    """
+    Create a structural fingerprint of a parsed object (HierarchyManager.parsed). The fingerprint is a tree with one
+    node per header, each holding the header, its skeleton depth, a digest of the text it owns directly (its title and
+    any text not under a lower header), and a Merkle-style hash rolled up from its own fields and its children's
+    hashes. Identical hashes mean identical subtrees, so diff() can skip unchanged sections entirely. Each node also
+    holds a content hash, rolled up in the same way but without depths, so that diff() can recognize a section moved to
+    another depth.
+
+    :param parsed: parsed object, or a list of top-level sections.
+    :return: fingerprint root node (header None, depth -1).
+    """
+
+    root = new_root()
+    add_sections(root, parsed)
+
+    return finish(root)
+
+
+def new_root():
+    """
+    Create an empty fingerprint root, to be filled with add_sections() and sealed with finish().
+    """
+
+    return _new_node(None, -1, [])
+
+
+def add_sections(root, sections):
+    """
+    Add top-level sections to an unfinished fingerprint root. Nodes are sealed as soon as their section is added, so
+    that texts are not retained when sections are added one at a time.
+    """
+
+    start = len(root['children'])
+    _walk(sections, root, 0)
+
+    for node in root['children'][start:]:
+        _seal(node)
+
+
+def finish(root):
+    """
+    Seal the root of a fingerprint built with add_sections().
+    """
+
+    return _seal(root)
+
+
+def skeleton(fp):
+    """
+    Create a skeleton of the organizational hierarchy from a fingerprint: one tab-indented line per header.
+    """
+
+    return [depth * '\t' + header + os.linesep for depth, header in outline(fp)]
+
+
+def outline(fp):
+    """
+    List the headers of a fingerprint in document order, as (depth, header) pairs.
+    """
+
+    out = []
+
+    def walk(node):
+        for child in node['children']:
+            out.append((child['depth'], child['header']))
+            walk(child)
+
+    walk(fp)
+
+    return out
+
+
+def diff(old, new):
+    """
+    Compare two fingerprints. Sections are matched by header among their siblings, and subtrees with identical hashes
+    are skipped, so the running time depends on the size of the change rather than the size of the document. Removed
+    and added sections with identical content (at any depth, including sections nested under a removed or added parent)
+    are reported as moved, and matched sections whose order among their siblings changed are reported as reordered.
+
+    :param old: fingerprint of the earlier version.
+    :param new: fingerprint of the later version.
+    :return: dictionary with 'added', 'removed', 'reordered', and 'changed' lists of header paths (tuples), and a
+        'moved' list of (old path, new path) pairs. 'changed' lists sections whose own text changed, and 'reordered'
+        lists the fewest sections whose moves among their siblings explain the new order.
+    """
+
+    report = {'added': [], 'removed': [], 'moved': [], 'reordered': [], 'changed': []}
+    removed = []
+    added = []
+
+    def walk(old_node, new_node, path):
+        if old_node['hash'] == new_node['hash']:
+            return
+
+        if old_node['digest'] != new_node['digest']:
+            report['changed'].append(path)
+
+        old_children = _keyed_children(old_node)
+        new_children = _keyed_children(new_node)
+        old_keys = dict(old_children)
+        new_keys = dict(new_children)
+
+        for key, child in old_children:
+            if key not in new_keys:
+                removed.append((path + (child['header'],), child))
+
+        old_positions = dict((key, i) for i, (key, child) in enumerate(old_children))
+        matched = [(old_positions[key], child) for key, child in new_children if key in old_positions]
+        for child in _out_of_order(matched):
+            report['reordered'].append(path + (child['header'],))
+
+        for key, child in new_children:
+            if key in old_keys:
+                walk(old_keys[key], child, path + (child['header'],))
+            else:
+                added.append((path + (child['header'],), child))
+
+    walk(old, new, ())
+
+    # pair up removed and added sections with identical content as moves, including sections nested in removed or added
+    # subtrees (e.g. a section moved into a new parent); pairing a section claims its whole subtree and its ancestors
+    added_by_content = {}
+    for path, node in _descendants(added):
+        added_by_content.setdefault(node['content'], []).append((path, node))
+
+    claimed = set()
+    moved_paths = set()
+
+    def pair(path, node):
+        candidates = added_by_content.get(node['content'], [])
+        for i, (new_path, new_node) in enumerate(candidates):
+            if new_path not in claimed:
+                del candidates[i]
+                claimed.update(p for p, n in _descendants([(new_path, new_node)]))
+                claimed.update(new_path[:k] for k in range(1, len(new_path)))
+                report['moved'].append((path, new_path))
+                moved_paths.add(path)
+                moved_paths.add(new_path)
+                return
+
+        for child in node['children']:
+            pair(path + (child['header'],), child)
+
+    for path, node in removed:
+        pair(path, node)
+
+    report['removed'] = [path for path, node in removed if path not in moved_paths]
+    report['added'] = [path for path, node in added if path not in moved_paths]
+
+    return report
+
+
+def dump(fp, path):
+    """
+    Write a fingerprint to disk as JSON.
+    """
+
+    with open(path, 'wb') as f:
+        json.dump(fp, f, separators=(',', ':'))
+
+
+def load(path):
+    """
+    Read a fingerprint written by dump().
+    """
+
+    with open(path, 'rb') as f:
+        return json.load(f)
+
+
+def _keyed_children(node):
+    """
+    Return a node's children as (key, child) pairs, keyed by (header, occurrence of that header among siblings).
+    """
+
+    counts = {}
+    items = []
+    for child in node['children']:
+        occurrence = counts.get(child['header'], 0)
+        counts[child['header']] = occurrence + 1
+        items.append(((child['header'], occurrence), child))
+
+    return items
+
+
+def _descendants(items):
+    """
+    Given (path, node) pairs, return them and all of their descendants as (path, node) pairs, in document order.
+    """
+
+    out = []
+
+    def walk(path, node):
+        out.append((path, node))
+        for child in node['children']:
+            walk(path + (child['header'],), child)
+
+    for path, node in items:
+        walk(path, node)
+
+    return out
+
+
+def _out_of_order(items):
+    """
+    Given (old position, item) pairs in their new order, return the items outside a longest subsequence that kept its
+    old order, i.e. the fewest items whose moves explain the new order.
+    """
+
+    # patience sorting: tails[k] is the item index ending the best increasing run of length k + 1 found so far
+    tails = []
+    tail_positions = []
+    previous = [None] * len(items)
+
+    for i, (position, item) in enumerate(items):
+        k = bisect.bisect_left(tail_positions, position)
+        if k:
+            previous[i] = tails[k - 1]
+
+        if k == len(tails):
+            tails.append(i)
+            tail_positions.append(position)
+        else:
+            tails[k] = i
+            tail_positions[k] = position
+
+    kept = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        kept.add(i)
+        i = previous[i]
+
+    return [item for i, (position, item) in enumerate(items) if i not in kept]
+
+
+def _new_node(header, depth, texts):
+    return {'header': header, 'depth': depth, 'texts': texts, 'children': []}
+
+
+def _walk(obj, node, depth):
+    """
+    Collect header nodes and their texts, using the same depth rules as the skeleton.
+    """
+
+    for entry in obj:
+        if entry['header']:
+            owner = _new_node(entry['header'], depth, [entry['text']])
+            node['children'].append(owner)
+        else:
+            owner = node
+            owner['texts'].append(entry['text'])
+
+        if entry['children']:
+            if entry['children'][0]['header']:
+                _walk(entry['children'], owner, depth + 1)
+            else:
+                _walk(entry['children'], owner, depth)
+
+
+def _seal(node):
+    """
+    Replace collected texts with a digest, and compute the node hash from its fields and its children's hashes, and the
+    content hash from the same without depths.
+    """
+
+    if 'texts' in node:
+        for child in node['children']:
+            _seal(child)
+
+        text = u'\n'.join(t for t in node.pop('texts') if t)
+        node['digest'] = _digest(text.encode('utf-8'))
+
+        header = node['header'] if node['header'] is not None else u''
+        node['hash'] = _digest('\0'.join([header.encode('utf-8'), str(node['depth']), node['digest']] +
+                                         [child['hash'] for child in node['children']]))
+        node['content'] = _digest('\0'.join([header.encode('utf-8'), node['digest']] +
+                                            [child['content'] for child in node['children']]))
+
+    return node
+
+
+def _digest(data):
+    return hashlib.sha1(data).hexdigest()[:16]
@@ -4,19 +4,31 @@
 # Last updated on September 22, 2016
 # @author: Robert Shaffer
 
+# heavy modules (tempfile, multiprocessing, and the diff and sink modules with their json, hashlib, and sqlite3
+# dependencies) are imported only in the entry points that need them, to keep startup time low for short-lived worker
+# processes. Compiled patterns and probe results are cached at module level, so long-lived processes (see worker.py)
+# reuse them across documents.
 import os
 import re
-import _file_utils as utils
-import inspect
+import math
+import array
+import time
+import marshal
 import unicodedata
+import _file_utils as utils
 from copy import deepcopy
-from itertools import chain
 
 
 
+# compiled combined header patterns, keyed by (header regex, flags)
+_regex_cache = {}
+# diagnostic probe results, keyed by (pattern, flags, probe unit, probe budget)
+_probe_cache = {}
+
+
 class HierarchyManager:
     def __init__(self, text_path, header_regex, tag_path=None, preamble_level=0, case_sensitive=False,
-                 tag_format='ccp'):
+                 tag_format='ccp', time_budget=None, low_memory=False):
         """
         Regular expression-based tagger. Wraps Segmenter and uses outputs to apply content tags to hierarchy levels.
         Also generates a few reports and formats output.
@@ -27,18 +39,24 @@ class HierarchyManager:
         :param preamble_level: optionally, highest-level organizational tag following the document's preamble.
         :param case_sensitive: indicator for whether the header regex matches should be case-sensitive.
         :param tag_format: format in which tag data are given.
+        :param time_budget: optionally, maximum number of seconds to spend segmenting the document. If given, header
+            regex are checked for pathological backtracking before parsing, and parsing aborts once the budget is spent.
+        :param low_memory: if True, intermediate copies of the text are released as soon as they are used, and the
+            document is segmented one top-level section at a time. Use with stream_output() to keep peak memory bounded.
         :return:
         """
 
         # read raw text data, get tags, set flags, create containers for outputs
-        self.pwd = os.path.dirname(inspect.getfile(inspect.currentframe()))
         self.file_name = re.sub('\..+', '', os.path.basename(text_path))
 
         self.header_regex = header_regex
+        self.low_memory = low_memory
 
         self.text = None
         self.parsed = None
         self.skeleton = None
+        self.fingerprint = None
+        self.header_report = None
         self.tag_data = None
 
         if case_sensitive:
@@ -49,7 +67,9 @@ class HierarchyManager:
         self.text = utils.TextLoader(text_path).content
 
         # read reference data, if any
-        self.tag_data = utils.TagLoader(tag_path, tag_format).data
+        tag_loader = utils.TagLoader(tag_path, tag_format)
+        self.tag_data = tag_loader.data
+        self.tag_references = tag_loader.references
 
         if self.tag_data:
             self.tag_report = []
@@ -57,33 +77,40 @@ class HierarchyManager:
             self.tag_report = None
 
         # initialize Segmenter()
-        self.parser = _Parser(self.text, self.header_regex, self.case_flags, preamble_level)
+        self.parser = _Parser(self.text, self.header_regex, self.case_flags, preamble_level, time_budget)
+
+        if self.low_memory:
+            self.text = None
 
-    def parse(self):
+    def diagnose(self):
+        """
+        Pre-flight check of the header regex. Reports match counts and match times per header level, and flags
+        patterns whose runtime grows superlinearly with input length. Report is placed in self.header_report.
+        """
+
+        self.header_report = self.parser.diagnose()
+        print(_format_diagnostics(self.header_report))
+
+    def parse(self, processes=None):
         """
         Parse the document. This function largely wraps the Segmenter class, and creates a skeleton of the
         organizational hierarchy that can be used as a diagnostic tool.
-        """
 
-        def create_skeleton(obj, out=None, depth=0):
-            if not out:
-                out = []
+        :param processes: optionally, number of worker processes used to segment top-level sections in parallel (see
+            _Parser.segment). Not used in low-memory mode.
+        """
 
-            for entry in obj:
-                if entry['header']:
-                    header_to_write = entry['header']
-                    out.append(depth * '\t' + header_to_write + os.linesep)
+        if self.low_memory:
+            self.parsed = list(self.parser.iter_sections())
+        else:
+            self.parser.segment(processes)
+            self.parsed = self.parser.parsed
 
-                if entry['children']:
-                    if entry['children'][0]['header']:
-                        out = create_skeleton(entry['children'], out, depth+1)
-                    else:
-                        out = create_skeleton(entry['children'], out, depth)
-            return out
+        import diff
 
-        self.parser.segment()
-        self.parsed = self.parser.parsed
-        self.skeleton = create_skeleton(self.parsed)
+        self.header_report = self.parser.diagnostics
+        self.fingerprint = diff.fingerprint(self.parsed)
+        self.skeleton = diff.skeleton(self.fingerprint)
 
     def apply_tags(self):
         """
@@ -100,18 +127,6 @@ class HierarchyManager:
             and tag application.
             """
 
-            def format_header(h):
-                """
-                Helper function to strip sequences not used for matching from headers (e.g. "Title" or "Article")
-                """
-                h = h.lower()
-                h = ''.join(e for e in h if unicodedata.category(e)[0] not in ['P', 'C'])
-
-                if h != 'preamble':
-                    h = re.sub('[a-zA-Z]{3,}|\s+', '', h)
-
-                return h
-
             if not out:
                 out = {}
 
@@ -122,11 +137,11 @@ class HierarchyManager:
                 if current_header:
                     updated_header = deepcopy(current_header)
                     if header:
-                        updated_header['header'].append(format_header(header))
+                        updated_header['header'].append(utils.format_header(header))
 
                     updated_header['key'].append(i)
                 else:
-                    updated_header = {'header': [format_header(header)], 'key': [i]}
+                    updated_header = {'header': [utils.format_header(header)], 'key': [i]}
 
                 if entry['text_type'] != 'body':
                     joined_header = '.'.join(h for h in updated_header['header'] if h)
@@ -153,17 +168,30 @@ class HierarchyManager:
         stub_table = create_stub_table(self.parsed)
 
         # check for tag matches and apply tags to the parsed object
+        for tag_name, stub in self._match_tags(stub_table):
+            key_sequence = deepcopy(stub_table[stub])
+            self.parsed = apply_tag(self.parsed, key_sequence, tag_name)
+
+    def _match_tags(self, stub_table):
+        """
+        Match tag references against a stub table. Unmatched or ambiguous tags are added to self.tag_report.
+
+        :param stub_table: dictionary keyed by joined header stubs.
+        :return: list of (tag name, matched stub) pairs.
+        """
+
+        matched = []
+
         if self.tag_data:
+            stub_index = _index_stubs(stub_table)
+
             for tag_entry in self.tag_data:
-                tag_name = tag_entry['tag']
-                tag_reference = tag_entry['article']
+                tag_reference = self.tag_references[tag_entry['article']]
 
-                matches = [s for s in stub_table if re.search('^' + tag_reference + '$|\.' + tag_reference + '$', s,
-                                                              self.case_flags)]
+                matches = stub_index.get(tag_reference, []) if tag_reference else []
 
                 if len(matches) == 1:
-                    key_sequence = deepcopy(stub_table[matches[0]])
-                    self.parsed = apply_tag(self.parsed, key_sequence, tag_name)
+                    matched.append((tag_entry['tag'], matches[0]))
                 else:
                     self.tag_report.append(tag_entry)
 
@@ -174,59 +202,102 @@ class HierarchyManager:
             else:
                 print('All tags successfully matched.')
 
-    def create_output(self, output_format='ccp'):
-        """
-        Format the parsed object for easier output.
+        return matched
 
-        :param output_format: format to use. Only CCP format currently implemented.
+    def stream_output(self, out, output_format='ccp'):
+        """
+        Parse, tag, and write the document without holding the full parsed object or output table in memory. Top-level
+        sections are segmented and flattened one at a time, and rows are spooled to a temporary file until tags have
+        been matched. Equivalent to calling parse(), apply_tags(), and create_output() and writing the rows as CSV,
+        except that self.parsed is not kept.
+
+        :param out: path to the output CSV, or a sinks.Sink with a document already started, to which rows are written
+            as the 'sections' table.
+        :param output_format: CCP format to use ('ccp' or 'ccp_multilingual').
         """
 
-        def format_ccp(obj, out=None, parent_index=0):
-            """
-            CCP format setup. Outputs a CSV with document hierarchy expressed using parent/child index columns.
-            """
-            if not out:
-                out = []
+        import diff
+        import sinks
+        import tempfile
 
-            for i in range(len(obj)):
-                entry = obj[i]
+        stub_table = {}
+        fingerprint = diff.new_root()
+        n_rows = 0
 
-                if entry['header']:
-                    header_to_write = entry['header']
-                else:
-                    header_to_write = ''
+        spool = tempfile.TemporaryFile()
+        try:
+            for section in self.parser.iter_sections():
+                rows = _format_ccp([section], offset=n_rows, stubs=stub_table)
+                diff.add_sections(fingerprint, [section])
 
-                split_text = re.split('[\n\r]+', entry['text'])
-                for line in split_text:
-                    current_index = len(out)+1
+                for row in rows:
+                    marshal.dump(row, spool)
+                n_rows += len(rows)
 
-                    if entry['text_type'] != 'body' or line:
-                        out.append([str(current_index), str(parent_index), header_to_write, '',
-                                    entry['text_type'], line] + entry['tags'])
+            self.header_report = self.parser.diagnostics
+            self.fingerprint = diff.finish(fingerprint)
+            self.skeleton = diff.skeleton(self.fingerprint)
 
-                if entry['children']:
-                    out = format_ccp(entry['children'], out, parent_index=len(out))
+            row_tags = {}
+            for tag_name, stub in self._match_tags(stub_table):
+                for row_index in stub_table[stub]:
+                    row_tags.setdefault(row_index, []).append(tag_name)
 
-            return out
+            max_cols = 6 + max([len(tags) for tags in row_tags.values()] + [0])
 
-        if 'ccp' in output_format:
-            out_data = format_ccp(self.parsed)
+            # multilingual rows repeat the header and text columns
+            width = max_cols + 4 if 'multilingual' in output_format else max_cols
+            columns = ccp_columns(width, output_format)
+
+            def spooled_rows():
+                spool.seek(0)
+                for i in range(n_rows):
+                    row = marshal.load(spool)
+                    yield _format_ccp_row(row + row_tags.get(row[0], []), max_cols, output_format, False)
+
+            if isinstance(out, sinks.Sink):
+                out.write('sections', spooled_rows(), columns=columns)
+            else:
+                # sink paths are templates, so braces in the literal path are escaped
+                with sinks.CSVSink({'sections': out.replace('{', '{{').replace('}', '}}')},
+                                   headerless=['sections']) as sink:
+                    sink.begin(self.file_name)
+                    sink.write('sections', spooled_rows(), columns=columns)
+        finally:
+            spool.close()
+
+    def create_output(self, output_format='ccp'):
+        """
+        Format the parsed object for easier output.
+
+        :param output_format: format to use. Either a CCP format ('ccp' or 'ccp_multilingual'), which returns a list of
+            string rows, or 'columnar', which returns a utils.ColumnarTable with typed index columns.
+        """
+
+        if output_format == 'columnar':
+            return utils.ColumnarTable(_format_ccp(self.parsed))
+
+        elif 'ccp' in output_format:
+            out_data = _format_ccp(self.parsed)
 
             # rectangularize
             max_cols = max(len(row) for row in out_data)
-            out_data = [row + ['']*(max_cols - len(row)) for row in out_data]
-
-            if 'multilingual' in output_format:
-                out_data = [row[0:2] + 3*[row[2]] + row[3:5] + 3*[row[5]] + row[6:] for row in out_data]
+            out_data = [_format_ccp_row(row, max_cols, output_format) for row in out_data]
 
             return out_data
 
         else:
-            print('Only CCP output format currently implemented.')
+            print('Only CCP and columnar output formats currently implemented.')
 
 
 class _Parser:
-    def __init__(self, text, header_regex, case_flags, preamble_level):
+    # probe units repeated to build diagnostic inputs. Units are synthetic: sampling them from the document would mean
+    # running the header regex over document text before it has been checked
+    probe_units = [u'a', u'A', u'1', u' ', u'.', u'a ', u'1.', u'a1:', u'(a) ', u'I. ', u'Article 1. ']
+    # probe lengths: fine-grained steps while exponential blowup is still cheap to observe, then doubling
+    probe_lengths = range(4, 36, 4) + [48, 64, 128, 256, 512, 1024]
+
+    def __init__(self, text, header_regex, case_flags, preamble_level, time_budget=None, probe_budget=0.05):
         """
         Segmenter class, which does actual document segmentation work. Intended to be called through HierarchyTagger.
 
@@ -234,199 +305,452 @@ class _Parser:
         :param header_regex: list of header regex to be used for segmentation
         :param preamble_level: highest-level organizational tag following the document's preamble.
         :param case_flags: indicator for whether the header regex matches should be case-sensitive.
+        :param time_budget: optionally, maximum number of seconds to spend on diagnostics and segmentation.
+        :param probe_budget: maximum number of seconds a single diagnostic probe may take before its pattern is flagged.
         """
 
         self.text = text
         self.header_regex = ['^' + unicode(h, encoding='utf8').replace('|', '|^') for h in header_regex]
         self.preamble_level = preamble_level
         self.case_flags = case_flags
+        self.time_budget = time_budget
+        self.probe_budget = probe_budget
+
+        self.diagnostics = None
+        self._deadline = None
+
+        # all header levels combined into one alternation (earlier levels take priority at the same position), plus
+        # combined patterns for the levels below each level, used for headers that follow a header on the same line
+        # (None if the levels cannot be combined, see _compile_levels)
+        cache_key = (tuple(self.header_regex), self.case_flags)
+        if cache_key not in _regex_cache:
+            if len(_regex_cache) > 1000:
+                _regex_cache.clear()
+            _regex_cache[cache_key] = _compile_levels(self.header_regex, self.case_flags)
+
+        self.combined_regex, self.deeper_regex = _regex_cache[cache_key]
+
+        # the preamble split runs the preamble-level regex over the whole text before any budget is started, so check
+        # that level first. Other levels are checked by diagnose() once segmentation starts
+        if time_budget is not None and 0 <= preamble_level < len(self.header_regex):
+            growth = self._probe_all(re.compile(self.header_regex[preamble_level], self.case_flags))
+            if growth is not None:
+                raise Exception('Preamble-level header regex {0!r} has superlinear runtime ({1}); aborting to stay '
+                                'within the time budget.'.format(self.header_regex[preamble_level], growth))
 
         self.parsed, self.list_table = self._pre_process()
 
-    def segment(self):
+    def segment(self, processes=None):
         """
         Set up organizational headers, using regex list provided in self.header_regex. Text is pre-processed, then
         segmented into a hierarchical structure. Regular text and auxiliary list table are segmented separately, and
         then reassembled into a single output.
+
+        If a time budget is set, header regex are first checked with diagnose(), and segmentation aborts with a report
+        once the budget is spent.
+
+        :param processes: optionally, number of worker processes. If greater than 1, the text is split by the top-level
+            header, and top-level sections (with the lists they contain) are segmented by the remaining levels and
+            reassembled in a process pool. Results are merged in document order, so the output is identical to serial
+            segmentation.
         """
 
-        def shatter(obj, header_tag, case_flags):
-                """
-                Recursive function to segment a given object, using a given organizational tag. Segmented items are
-                placed under the "children" key of the object, and then recursively segmented if any additional headers
-                matching the same tag are present.
-
-                :param obj: Dictionary object to segmented. Expected to be tabulated text or list container object.
-                :param header_tag: Regex tag for a particular header.
-                :param case_flags: Flags for case sensitivity.
-                :return: segmented obj
-                """
+        self._start_budget()
 
-                # iterate over object (note that object may change size during iteration)
-                entry_counter = 0
-
-                while entry_counter < len(obj):
-                    entry = obj[entry_counter]
-
-                    header_matches = list(re.finditer(header_tag, entry['text'], flags=case_flags))
-
-                    # if a header match is found, split the text into pre-match start_stub and post-match content
-                    if len(header_matches) > 0:
-                        header_starts = [header.start() for header in header_matches]
-                        header_starts.append(len(entry['text']))
-
-                        start_stub = entry['text'][:header_starts[0]].strip('\t\n\r ')
-
-                        new_entries = []
-
-                        # for all header matches in post-match content, extract titles and text and format an entry
-                        for j, header_regex in enumerate(header_matches):
-                            text = entry['text'][header_regex.end():header_starts[j+1]].strip('\t\n\r ')
-
-                            first_line_index = re.search('[\n\r]', text)
-                            if not first_line_index:
-                                first_line_index = len(text)
-                            else:
-                                first_line_index = first_line_index.end()
-
-                            first_line = text[:first_line_index]
-                            first_line = first_line.strip('\t\n\r ')
-
-                            if '<title>' in first_line and '</title>' in first_line:
-                                title = re.search('<title>.*?</title>', first_line)
-                            elif '<title>' in first_line:
-                                title = re.search('.*<title>.*', first_line)
-                            else:
-                                title = None
-
-                            header = header_regex.group(0).strip('\t\n\r ')
-                            header = re.sub('[,|;^#*]', '', header)
-                            header = re.sub('[-.:](?![A-Za-z0-9])', '', header)
-
-                            if title:
-                                text = first_line[:title.start()] + first_line[title.end():] + text[first_line_index:]
-                                title_text = re.sub('</?title>', '', title.group(0)).strip('\t\n\r ')
-                            else:
-                                title_text = ''
-
-                            new_entry = {'header': header,
-                                         'text': title_text,
-                                         'children': deepcopy(entry['children']),
-                                         'text_type': u'title',
-                                         'tags': []}
-
-                            new_entry['children'].insert(0, {'header': None,
-                                                             'text': text,
-                                                             'children': [],
-                                                             'text_type': u'body',
-                                                             'tags': []
-                                                             }
-                                                         )
-
-                            new_entries.append(new_entry)
-
-                        # handle case where organization "skips" a level
-                        # if we look to shatter content and children are already present, then that implies:
-                        #  - carry-over children from new entries are duplicates by definition (except for first one)
-                        #  - new entries should be on the same level as existing children
-                        # this section deletes duplicate children and adds new entries to same level as existing
-                        if entry['children']:
-                            for j in range(len(new_entries)):
-                                new_entries[j]['children'] = new_entries[j]['children'][0:1]
-
-                            entry['text'] = start_stub
-                            entry['children'] = new_entries + entry['children']
-
-                        # if there is a start_stub, then add new header matches as children of the current entry
-                        elif start_stub:
-                            entry['children'].insert(0, {'header': None,
-                                                         'text': start_stub,
-                                                         'children': new_entries,
-                                                         'text_type': u'body',
-                                                         'tags': []}
-                                                     )
-                            entry['text'] = ''
-
-                        # otherwise, add the new entries to the current level (keeping preexisting content)
-                        else:
-                            obj = obj[:entry_counter] + new_entries + obj[entry_counter + 1:]
-                            entry = obj[entry_counter]
-
-                    entry['children'] = shatter(entry['children'], header_tag, case_flags)
-                    entry_counter += 1
-
-                return obj
-
-        def assemble(obj, list_data):
-                """
-                Recursively reassemble the tabulated text and any lists extracted earlier. Lists are re-inserted at
-                their positions marked by the extract_lists() function.
+        # find the header levels present in the text and in each list, so that absent levels are not re-scanned
+        text_levels = set(self.detect_boundaries(_combine(self.parsed))[1])
+        list_levels = [set(self.detect_boundaries(list_entry[0]['text'])[1]) for list_entry in self.list_table]
 
-                :param obj: tabulated text object being checked for lists
-                :param list_data: table of lists extracted earlier
-                :return: assembled obj
-                """
+        if processes > 1:
+            self._segment_parallel(processes, text_levels, list_levels)
+            self._check_desync()
+            return
 
-                # iterate through the object until end is reached
-                entry_counter = 0
-                while entry_counter < len(obj):
-                    entry = obj[entry_counter]
-                    list_search = re.search('\{@([0-9]+)\}', entry['text'], flags=re.M)
+        # shatter tabulated file and the list table
+        for level, tag in enumerate(self.header_regex):
+            if level in text_levels:
+                self.parsed = _shatter(self.parsed, tag, self.case_flags, self._check_budget)
 
-                    # if a list is present, separate pre/post list content into two separate entries, insert the list as
-                    # a set of children under the pre-list entry, and add the post-list entry if present
-                    if list_search:
-                        list_entry = list_data[int(list_search.group(1))]
+            for i in range(len(self.list_table)):
+                if level in list_levels[i]:
+                    self.list_table[i] = _shatter(self.list_table[i], tag, self.case_flags, self._check_budget)
 
-                        new_entries = []
+        # reassemble the tabulated file and the list table together
+        self.parsed = _assemble(self.parsed, self.list_table)
 
-                        pre_list_entry = deepcopy(entry)
-                        post_list_entry = deepcopy(entry)
+        self._check_desync()
 
-                        pre_list_entry['text'] = entry['text'][:list_search.start()].strip('\n\r ')
-                        post_list_entry['text'] = entry['text'][list_search.end():].strip('\n\r ')
+    def _segment_parallel(self, processes, text_levels, list_levels):
+        """
+        Parallel counterpart of the shatter/assemble steps in segment(). Top-level sections are grouped into contiguous
+        chunks of roughly equal text length, and each chunk is sent to a worker along with the lists it references
+        (including nested lists). Workers return the segmented chunk and its lists in a single object, so that lists
+        inserted into the tree remain the same objects as the corresponding entries in self.list_table.
+        """
 
-                        if len(list_entry) > 1:
-                            for i in range(len(list_entry)):
-                                list_entry[i]['text_type'] = u'olist'
+        import multiprocessing
+
+        if 0 in text_levels:
+            self.parsed = _shatter(self.parsed, self.header_regex[0], self.case_flags, self._check_budget)
+
+        # group sections into chunks, aiming for a few chunks per process to balance uneven section lengths
+        sizes = [len(_combine([entry])) for entry in self.parsed]
+        chunk_size = max(sum(sizes) / (4 * processes), 1)
+
+        chunks = [[]]
+        chunk_length = 0
+        for entry, size in zip(self.parsed, sizes):
+            if chunk_length >= chunk_size:
+                chunks.append([])
+                chunk_length = 0
+            chunks[-1].append(entry)
+            chunk_length += size
+
+        # find the lists referenced by each chunk, following nested lists
+        jobs = []
+        assigned = set()
+        for chunk in chunks:
+            referenced = set()
+            to_check = [int(i) for i in re.findall('\{@([0-9]+)\}', _combine(chunk))]
+            while to_check:
+                i = to_check.pop()
+                if i not in referenced:
+                    referenced.add(i)
+                    to_check.extend(int(j) for j in re.findall('\{@([0-9]+)\}', self.list_table[i][0]['text']))
+
+            assigned.update(referenced)
+            jobs.append((chunk, self.header_regex, self.case_flags, text_levels,
+                         dict((i, self.list_table[i]) for i in referenced),
+                         dict((i, list_levels[i]) for i in referenced), self._deadline, self.time_budget))
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_segment_sections, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        # merge in document order, and write segmented lists back to the list table
+        self.parsed = []
+        for chunk, lists in results:
+            self.parsed.extend(chunk)
+            for i in lists:
+                self.list_table[i] = lists[i]
+
+        # lists not referenced from any section are segmented here, as in serial segmentation
+        for i in range(len(self.list_table)):
+            if i not in assigned:
+                for level, tag in enumerate(self.header_regex):
+                    if level in list_levels[i]:
+                        self.list_table[i] = _shatter(self.list_table[i], tag, self.case_flags, self._check_budget)
+
+    def iter_sections(self):
+        """
+        Low-memory alternative to segment(). Once the top-level header split is done, each top-level section is
+        segmented by the remaining header levels, reassembled with its lists, checked for desynchronization against its
+        own pre-segmentation text, and yielded, so that only one fully segmented section is held at a time. The
+        original text is released once the top-level split is done, so segment() cannot be called afterwards.
 
-                            pre_list_entry['children'] = list_entry
-                        else:
-                            pre_list_entry['children'] = [{'header': '',
-                                                           'text': '',
-                                                           'children': list_entry,
-                                                           'text_type': u'ulist',
-                                                           'tags': []}]
+        :return: generator of segmented top-level entries, in document order.
+        """
 
-                        new_entries.append(pre_list_entry)
+        self._start_budget()
 
-                        if post_list_entry['text'] or post_list_entry['children']:
-                            new_entries.append(post_list_entry)
+        # keep the unsegmented list text for per-section desync checks, then segment the list table
+        list_text = [list_entry[0]['text'] for list_entry in self.list_table]
+        list_levels = [set(self.detect_boundaries(text_string)[1]) for text_string in list_text]
 
-                        # rebuild the object by combining earlier content, re-inserted content, and later content
-                        updated_obj = obj[:entry_counter] + new_entries + obj[entry_counter + 1:]
-                        obj = updated_obj
+        for level, tag in enumerate(self.header_regex):
+            for i in range(len(self.list_table)):
+                if level in list_levels[i]:
+                    self.list_table[i] = _shatter(self.list_table[i], tag, self.case_flags, self._check_budget)
 
-                    # recursively apply assemble() to check for lists in children of the current object
+        text_levels = set(self.detect_boundaries(_combine(self.parsed))[1])
 
-                    if obj[entry_counter]['children']:
-                        obj[entry_counter]['children'] = assemble(obj[entry_counter]['children'], list_data)
+        sections = _shatter(self.parsed, self.header_regex[0], self.case_flags, self._check_budget)
+        self.parsed = None
+        self.text = None
 
-                    entry_counter += 1
+        def expand_lists(text_string):
+            return re.sub('\{@([0-9]+)\}', lambda m: '\n' + expand_lists(list_text[int(m.group(1))]) + '\n',
+                          text_string)
 
-                return obj
+        # pop sections off the end of a reversed list, so that each is released once yielded
+        sections.reverse()
+        while sections:
+            section = [sections.pop()]
+            section_text = expand_lists(_combine(section))
 
-        # shatter tabulated file and the list table
-        for tag in self.header_regex:
-            self.parsed = shatter(self.parsed, tag, self.case_flags)
+            for level, tag in enumerate(self.header_regex[1:], 1):
+                if level in text_levels:
+                    section = _shatter(section, tag, self.case_flags, self._check_budget)
+            section = _assemble(section, self.list_table)
 
-            for i in range(len(self.list_table)):
-                self.list_table[i] = shatter(self.list_table[i], tag, self.case_flags)
+            self._check_desync(section_text, section)
 
-        # reassemble the tabulated file and the list table together
-        self.parsed = assemble(self.parsed, self.list_table)
+            for entry in section:
+                yield entry
 
-        self._check_desync()
+    def detect_boundaries(self, text):
+        """
+        Find header boundaries for all levels in a single pass. Headers are matched at line starts with one combined
+        alternation, with higher levels taking priority at the same position. Since shatter() strips the text following
+        a header, lower-level headers that follow a header on the same line (directly or at the start of a title) are
+        also detected. If the header regex cannot be combined (see _compile_levels), each level is matched separately
+        instead.
+
+        :param text: text to scan (e.g. pre-processed body text or a list from the list table).
+        :return: (offsets, levels, ends) arrays, sorted by offset.
+        """
+
+        offsets = array.array('i')
+        levels = array.array('i')
+        ends = array.array('i')
+
+        for start, level, end in self._match_lines(text):
+            offsets.append(start)
+            levels.append(level)
+            ends.append(end)
+
+            # follow headers chained on the same line (e.g. "Article 5: 1. ...")
+            line_end = text.find('\n', end)
+            if line_end < 0:
+                line_end = len(text)
+
+            while level + 1 < len(self.header_regex):
+                candidates = [end] + [end + t.end() for t in re.finditer('<title>', text[end:line_end])]
+                chained = None
+
+                for candidate in candidates:
+                    rest = text[candidate:line_end]
+                    start = candidate + len(rest) - len(rest.lstrip('\t\r '))
+
+                    chained = self._match_below(text[start:line_end], level)
+                    if chained and chained[1] > 0:
+                        break
+                    chained = None
+
+                if not chained:
+                    break
+
+                level, length = chained
+                offsets.append(start)
+                levels.append(level)
+                ends.append(start + length)
+                end = start + length
+
+        return offsets, levels, ends
+
+    def _match_lines(self, text):
+        """
+        Generate (start, level, end) for the headers matched at line starts, with earlier levels taking priority at the
+        same position.
+        """
+
+        if self.combined_regex is not None:
+            for match in self.combined_regex.finditer(text):
+                yield match.start(), int(match.lastgroup[len('level'):]), match.end()
+            return
+
+        # levels matched separately: keep the highest level at each position, and drop overlapping matches
+        found = {}
+        for level in reversed(range(len(self.header_regex))):
+            for match in re.finditer(self.header_regex[level], text, self.case_flags):
+                found[match.start()] = (match.start(), level, match.end())
+
+        end = 0
+        for start in sorted(found):
+            if start >= end:
+                yield found[start]
+                end = max(found[start][2], start + 1)
+
+    def _match_below(self, text, level):
+        """
+        Match a header of any level below the given level at the start of text. Returns (level, end), or None.
+        """
+
+        if self.combined_regex is not None:
+            match = self.deeper_regex[level].match(text)
+            return match and (int(match.lastgroup[len('level'):]), match.end())
+
+        for lower in range(level + 1, len(self.header_regex)):
+            match = re.match(self.header_regex[lower], text, self.case_flags)
+            if match:
+                return lower, match.end()
+
+        return None
+
+    def check_boundaries(self):
+        """
+        Check that detect_boundaries() agrees with the headers found by per-level shatter(). Each pre-processed text
+        segment (preamble, body, and each list) is segmented level by level, and the resulting headers (in document
+        order, with their levels) are compared against the detected boundaries. Prints the first mismatch, if any.
+
+        :return: True if all boundaries match.
+        """
+
+        def mark_levels(obj, level):
+            for entry in obj:
+                if entry['header'] and '_level' not in entry:
+                    entry['_level'] = level
+                mark_levels(entry['children'], level)
+
+        def collect(obj, out):
+            for entry in obj:
+                if '_level' in entry:
+                    out.append((entry['_level'], entry['header']))
+                collect(entry['children'], out)
+            return out
+
+        segments = [[{'header': None, 'text': _combine([entry]), 'children': [], 'text_type': u'body', 'tags': []}]
+                    for entry in self.parsed] + deepcopy(self.list_table)
+
+        matched = True
+        for segment in segments:
+            offsets, levels, ends = self.detect_boundaries(segment[0]['text'])
+            detected = [(levels[i], _clean_header(segment[0]['text'][offsets[i]:ends[i]]))
+                        for i in range(len(offsets))]
+
+            for level, tag in enumerate(self.header_regex):
+                segment = _shatter(segment, tag, self.case_flags)
+                mark_levels(segment, level)
+            shattered = collect(segment, [])
+
+            if detected != shattered:
+                mismatch = min(i for i in range(max(len(detected), len(shattered)) + 1)
+                               if detected[i:i+1] != shattered[i:i+1])
+                print('Warning! Detected header boundaries differ from segmented headers.')
+                print('Detected: ' + repr(detected[mismatch:mismatch+5]))
+                print('Segmented: ' + repr(shattered[mismatch:mismatch+5]))
+                matched = False
+
+        return matched
+
+    def _start_budget(self):
+        """
+        Start the time budget (if any), running diagnose() and aborting if any header regex is flagged.
+        """
+
+        if self.time_budget is not None:
+            self._deadline = time.time() + self.time_budget
+            self.diagnostics = self.diagnose()
+
+            flagged = [level for level in self.diagnostics if level['superlinear']]
+            if flagged:
+                raise Exception('Header regex with superlinear runtime found; aborting to stay within the time '
+                                'budget.' + os.linesep + _format_diagnostics(self.diagnostics))
+
+    def diagnose(self):
+        """
+        Pre-flight analysis of the header regex. Each level is first timed on synthetic probe inputs of increasing
+        length (built by repeating short units), and flagged as superlinear if a probe exceeds self.probe_budget or if
+        runtime grows faster than linearly with probe length. Only non-flagged levels are then run over the document to
+        collect match counts and timings. A single regex call cannot be interrupted, so a pattern that passes the probes
+        but backtracks badly on the document's own text is not caught.
+
+        Low-memory processing (see iter_sections()) releases the document text, after which the report computed before
+        the release (if any) is returned.
+
+        :return: list of per-level dictionaries with keys level, regex, matches, seconds, superlinear, and probe.
+        """
+
+        if self.text is None:
+            if self.diagnostics is not None:
+                return self.diagnostics
+
+            raise Exception('Header diagnostics need the document text, which is released by low-memory processing. '
+                            'Run diagnose() before parse() or stream_output(), or set a time budget.')
+
+        report = []
+
+        for level, header_tag in enumerate(self.header_regex):
+            self._check_budget('diagnosing ' + header_tag, report)
+
+            regex = re.compile(header_tag, self.case_flags)
+            growth = self._probe_all(regex)
+
+            level_report = {'level': level, 'regex': header_tag, 'matches': None, 'seconds': None,
+                            'superlinear': growth is not None, 'probe': growth}
+
+            if not level_report['superlinear']:
+                start = time.time()
+                level_report['matches'] = sum(1 for _ in regex.finditer(self.text))
+                level_report['seconds'] = time.time() - start
+
+            report.append(level_report)
+
+        self.diagnostics = report
+
+        return report
+
+    def _probe_all(self, regex):
+        """
+        Run _probe() for each probe unit, stopping at the first failing probe. Returns its description, or None.
+        """
+
+        for unit in self.probe_units:
+            growth = self._probe(regex, unit)
+            if growth is not None:
+                return growth
+
+        return None
+
+    def _probe(self, regex, unit):
+        """
+        Time a compiled header regex on increasingly long repetitions of unit. Returns a short description of the
+        failing probe if runtime exceeds the probe budget or grows superlinearly, and None otherwise. Results are cached
+        per process.
+        """
+
+        cache_key = (regex.pattern, regex.flags, unit, self.probe_budget)
+        if cache_key not in _probe_cache:
+            if len(_probe_cache) > 10000:
+                _probe_cache.clear()
+            _probe_cache[cache_key] = self._run_probe(regex, unit)
+
+        return _probe_cache[cache_key]
+
+    def _run_probe(self, regex, unit):
+
+        def time_search(probe):
+            repeats = 0
+            start = time.time()
+            while True:
+                regex.search(probe)
+                repeats += 1
+                elapsed = time.time() - start
+                if elapsed > self.probe_budget or elapsed > 5e-4 or repeats >= 100:
+                    return elapsed / repeats
+
+        timings = []
+        for length in self.probe_lengths:
+            probe = unit * length + u'\x00'
+            seconds = time_search(probe)
+            timings.append((length, seconds))
+
+            if seconds > self.probe_budget:
+                return '{0!r} x {1}: {2:.3f}s'.format(unit, length, seconds)
+
+        # compare the longest probe against one a quarter of its length
+        (short_length, short_seconds), (long_length, long_seconds) = timings[-3], timings[-1]
+        if short_seconds > 0 and long_seconds > 1e-4:
+            exponent = math.log(long_seconds / short_seconds) / math.log(float(long_length) / short_length)
+            if exponent > 1.5:
+                return '{0!r} x {1}: runtime ~ n^{2:.1f}'.format(unit, long_length, exponent)
+
+        return None
+
+    def _check_budget(self, stage, report=None):
+        """
+        Abort with a report if the time budget for this document has been spent.
+        """
+
+        if self._deadline is not None and time.time() > self._deadline:
+            report = report if report is not None else self.diagnostics
+            message = 'Time budget of {0}s exceeded while {1}.'.format(self.time_budget, stage)
+            if report:
+                message += os.linesep + _format_diagnostics(report)
+            raise Exception(message)
 
     def _pre_process(self):
         """
@@ -473,49 +797,53 @@ class _Parser:
                                 raise Exception('A list tag pair of the following type was malformed: ' +
                                                 opening_text)
 
-            def get_lists(text_data, list_counter):
-                if re.search('<(list_?[0-9]*)>', text_data):
-                    open_tag_regex = re.search('<(list_?[0-9]*)>[\n\r]*', text_data)
-                    close_tag_regex = re.search('[\n\r]*</' + open_tag_regex.group(1) + '>',
-                                                text_data[open_tag_regex.end():])
+            def get_lists(text_data, list_data):
+                """
+                Replace each outermost list in text_data with a {@*} marker, appending the extracted lists to
+                list_data. Lists nested inside an extracted list are left in its text. The text is scanned once, so
+                extraction stays linear in the length of the text.
+                """
+
+                out = []
+                position = 0
 
-                    list_section = text_data[open_tag_regex.end():(open_tag_regex.end() + close_tag_regex.start())]
+                while True:
+                    open_tag_regex = re.compile('<(list_?[0-9]*)>[\n\r]*').search(text_data, position)
+                    if not open_tag_regex:
+                        break
 
-                    text_data = text_data[:open_tag_regex.start()] + '{@' + str(list_counter) + '}' + \
-                                text_data[(open_tag_regex.end() + close_tag_regex.end()):]
+                    close_tag_regex = re.compile('[\n\r]*</' + open_tag_regex.group(1) + '>').search(
+                        text_data, open_tag_regex.end())
 
-                    list_obj = [{'header': None,
-                                 'text': list_section,
-                                 'children': [],
-                                 'text_type': 'body',
-                                 'tags': []}]
-                    return {'text': text_data, 'list_obj': list_obj, 'index': list_counter}
-                else:
-                    return None
+                    out.append(text_data[position:open_tag_regex.start()])
+                    out.append('{@' + str(len(list_data)) + '}')
+
+                    list_data.append([{'header': None,
+                                       'text': text_data[open_tag_regex.end():close_tag_regex.start()],
+                                       'children': [],
+                                       'text_type': 'body',
+                                       'tags': []}])
+
+                    position = close_tag_regex.end()
+
+                if not out:
+                    return text_data
+
+                out.append(text_data[position:])
+                return ''.join(out)
 
             check_list_syntax(text)
             list_data = []
 
             # get lists from text
-            while True:
-                list_output = get_lists(text, len(list_data))
-                if list_output:
-                    text = list_output['text']
-                    list_data.append(list_output['list_obj'])
-                else:
-                    break
+            text = get_lists(text, list_data)
 
-            # handle nested lists by iterating over the list table
+            # handle nested lists by iterating over the list table (which grows as nested lists are found)
             list_table_counter = 0
             while list_table_counter < len(list_data):
                 entry = list_data[list_table_counter][0]
-                list_output = get_lists(entry['text'], len(list_data))
-
-                if list_output:
-                    entry['text'] = list_output['text']
-                    list_data.append(list_output['list_obj'])
-                else:
-                    list_table_counter += 1
+                entry['text'] = get_lists(entry['text'], list_data)
+                list_table_counter += 1
 
             return text, list_data
 
@@ -572,11 +900,9 @@ class _Parser:
         to_process = to_process.replace('\n" .', '" .')
         to_process = to_process.replace(' >', '>')
 
-        preamble_tags = re.finditer('\s*(</?preamble>)\s*', to_process)
-        list_tags = re.finditer('\s+(</?list[_]?[0-9]*>)\s*', to_process)
-
-        for t in chain(list_tags, preamble_tags):
-            to_process = to_process.replace(t.group(0), t.group(1) + '\n')
+        # put list and preamble tags on their own lines, in one pass per tag type
+        to_process = re.sub('\s+(</?list[_]?[0-9]*>)\s*', '\\1\n', to_process)
+        to_process = re.sub('\s*(</?preamble>)\s*', '\\1\n', to_process)
 
         to_process = re.sub('[\n\r]+', '\n', to_process)
 
@@ -586,53 +912,52 @@ class _Parser:
 
         return segmented, lists
 
-    def _check_desync(self):
+    def _check_desync(self, original_text=None, parsed=None):
         """
         Sanity-checking function, which makes sure that the body text has been maintained after processing. If a
         desynchronization between the processed and original text occurs, then something has gone very wrong!
+
+        :param original_text: optionally, text to check against (defaults to self.text).
+        :param parsed: optionally, parsed object to check (defaults to self.parsed).
         """
 
         def minimal_format(text_string):
             text_string = re.sub('<.*?>', ' ', text_string)
             text_string = re.sub('\s+', ' ', text_string)
-            text_string = ''.join(e for e in text_string if unicodedata.category(e)[0] not in ['P', 'C'])
+
+            # delete punctuation and control characters, looking up each distinct character only once
+            deleted = dict((ord(e), None) for e in set(text_string) if unicodedata.category(e)[0] in ['P', 'C'])
+            text_string = text_string.translate(deleted)
             text_string = text_string.lower()
             text_string = text_string.strip()
             text_string = re.sub('\s+', ' ', text_string)
 
             return text_string
 
-        def combine(obj, out=None):
-            if not out:
-                out = u''
+        if original_text is None:
+            original_text = self.text
+        if parsed is None:
+            parsed = self.parsed
 
-            for entry in obj:
-                if entry['text']:
-                    out += u' ' + entry['text'].strip()
-                    out = out.strip()
-                if entry['children']:
-                    out = combine(entry['children'], out)
-
-            return out
-
-        original_text = self.text
-        for tag in self.header_regex:
-            tag = '^' + tag.replace('|', '|^')
-            original_text = re.sub(tag, ' ', original_text, flags=self.case_flags)
+        if self.combined_regex is not None:
+            original_text = self.combined_regex.sub(' ', original_text)
+        else:
+            for header_tag in self.header_regex:
+                original_text = re.sub(header_tag, ' ', original_text, flags=self.case_flags)
 
         original_text = minimal_format(original_text)
 
-        processed_text = combine(self.parsed)
+        processed_text = _combine(parsed)
         processed_text = minimal_format(processed_text)
 
-        desync_point = 0
-        while desync_point < min(len(processed_text), len(original_text)):
-            if processed_text[desync_point] != original_text[desync_point]:
-                break
-            else:
-                desync_point += 1
+        if processed_text != original_text:
+            desync_point = 0
+            while desync_point < min(len(processed_text), len(original_text)):
+                if processed_text[desync_point] != original_text[desync_point]:
+                    break
+                else:
+                    desync_point += 1
 
-        if len(processed_text) != len(original_text) or desync_point != len(processed_text):
             print('Warning! Desync between original and tabulated text found.')
 
             print('Original text fragment:')
@@ -641,6 +966,388 @@ class _Parser:
             print(processed_text[desync_point-50:desync_point+100])
 
 
+def _segment_sections(job):
+    """
+    Worker for _Parser._segment_parallel. Segments a chunk of top-level sections by all but the top-level header, along
+    with the lists referenced from the chunk, and reassembles them.
+
+    :param job: tuple of (sections, header regex, case flags, header levels present in the text, dictionary of list
+        index -> list, dictionary of list index -> header levels present in the list, deadline, time budget).
+    :return: (segmented sections, dictionary of list index -> segmented list)
+    """
+
+    sections, header_regex, case_flags, text_levels, lists, list_levels, deadline, time_budget = job
+
+    def check_budget(stage):
+        if deadline is not None and time.time() > deadline:
+            raise Exception('Time budget of {0}s exceeded while {1}.'.format(time_budget, stage))
+
+    for level, tag in enumerate(header_regex):
+        for i in lists:
+            if level in list_levels[i]:
+                lists[i] = _shatter(lists[i], tag, case_flags, check_budget)
+
+        if level > 0 and level in text_levels:
+            sections = _shatter(sections, tag, case_flags, check_budget)
+
+    sections = _assemble(sections, lists)
+
+    return sections, lists
+
+
+def _combine(obj, out=None):
+    """
+    Join the text of a parsed object (and all of its children) into a single string, in document order. Entries are
+    joined with line breaks, so that headers at the start of an entry still match line-anchored header regex.
+    """
+    if out is None:
+        out = []
+        _combine(obj, out)
+        return u'\n'.join(out)
+
+    for entry in obj:
+        if entry['text'] and entry['text'].strip():
+            out.append(entry['text'].strip())
+        if entry['children']:
+            _combine(entry['children'], out)
+
+
+def _shatter(obj, header_tag, case_flags, check_budget=None):
+    """
+    Recursive function to segment a given object, using a given organizational tag. Segmented items are
+    placed under the "children" key of the object, and then recursively segmented if any additional headers
+    matching the same tag are present.
+
+    :param obj: Dictionary object to segmented. Expected to be tabulated text or list container object.
+    :param header_tag: Regex tag for a particular header.
+    :param case_flags: Flags for case sensitivity.
+    :param check_budget: optionally, callable used to enforce a time budget between entries.
+    :return: segmented obj
+    """
+
+    # iterate over object (note that object may change size during iteration)
+    entry_counter = 0
+
+    while entry_counter < len(obj):
+        entry = obj[entry_counter]
+
+        if check_budget:
+            check_budget('segmenting with ' + header_tag)
+
+        header_matches = list(re.finditer(header_tag, entry['text'], flags=case_flags))
+
+        # if a header match is found, split the text into pre-match start_stub and post-match content
+        if len(header_matches) > 0:
+            header_starts = [header.start() for header in header_matches]
+            header_starts.append(len(entry['text']))
+
+            start_stub = entry['text'][:header_starts[0]].strip('\t\n\r ')
+
+            new_entries = []
+
+            # for all header matches in post-match content, extract titles and text and format an entry
+            for j, header_regex in enumerate(header_matches):
+                text = entry['text'][header_regex.end():header_starts[j+1]].strip('\t\n\r ')
+
+                first_line_index = re.search('[\n\r]', text)
+                if not first_line_index:
+                    first_line_index = len(text)
+                else:
+                    first_line_index = first_line_index.end()
+
+                first_line = text[:first_line_index]
+                first_line = first_line.strip('\t\n\r ')
+
+                if '<title>' in first_line and '</title>' in first_line:
+                    title = re.search('<title>.*?</title>', first_line)
+                elif '<title>' in first_line:
+                    title = re.search('.*<title>.*', first_line)
+                else:
+                    title = None
+
+                header = _clean_header(header_regex.group(0))
+
+                if title:
+                    text = first_line[:title.start()] + first_line[title.end():] + text[first_line_index:]
+                    title_text = re.sub('</?title>', '', title.group(0)).strip('\t\n\r ')
+                else:
+                    title_text = ''
+
+                new_entry = {'header': header,
+                             'text': title_text,
+                             'children': deepcopy(entry['children']),
+                             'text_type': u'title',
+                             'tags': []}
+
+                new_entry['children'].insert(0, {'header': None,
+                                                 'text': text,
+                                                 'children': [],
+                                                 'text_type': u'body',
+                                                 'tags': []
+                                                 }
+                                             )
+
+                new_entries.append(new_entry)
+
+            # handle case where organization "skips" a level
+            # if we look to shatter content and children are already present, then that implies:
+            #  - carry-over children from new entries are duplicates by definition (except for first one)
+            #  - new entries should be on the same level as existing children
+            # this section deletes duplicate children and adds new entries to same level as existing
+            if entry['children']:
+                for j in range(len(new_entries)):
+                    new_entries[j]['children'] = new_entries[j]['children'][0:1]
+
+                entry['text'] = start_stub
+                entry['children'] = new_entries + entry['children']
+
+            # if there is a start_stub, then add new header matches as children of the current entry
+            elif start_stub:
+                entry['children'].insert(0, {'header': None,
+                                             'text': start_stub,
+                                             'children': new_entries,
+                                             'text_type': u'body',
+                                             'tags': []}
+                                         )
+                entry['text'] = ''
+
+            # otherwise, add the new entries to the current level (keeping preexisting content)
+            else:
+                obj = obj[:entry_counter] + new_entries + obj[entry_counter + 1:]
+                entry = obj[entry_counter]
+
+        entry['children'] = _shatter(entry['children'], header_tag, case_flags, check_budget)
+        entry_counter += 1
+
+    return obj
+
+
+def _assemble(obj, list_data):
+    """
+    Recursively reassemble the tabulated text and any lists extracted earlier. Lists are re-inserted at
+    their positions marked by the extract_lists() function.
+
+    :param obj: tabulated text object being checked for lists
+    :param list_data: table of lists extracted earlier
+    :return: assembled obj
+    """
+
+    # iterate through the object until end is reached
+    entry_counter = 0
+    while entry_counter < len(obj):
+        entry = obj[entry_counter]
+        list_search = re.search('\{@([0-9]+)\}', entry['text'], flags=re.M)
+
+        # if a list is present, separate pre/post list content into two separate entries, insert the list as
+        # a set of children under the pre-list entry, and add the post-list entry if present
+        if list_search:
+            list_entry = list_data[int(list_search.group(1))]
+
+            new_entries = []
+
+            pre_list_entry = deepcopy(entry)
+            post_list_entry = deepcopy(entry)
+
+            pre_list_entry['text'] = entry['text'][:list_search.start()].strip('\n\r ')
+            post_list_entry['text'] = entry['text'][list_search.end():].strip('\n\r ')
+
+            if len(list_entry) > 1:
+                for i in range(len(list_entry)):
+                    list_entry[i]['text_type'] = u'olist'
+
+                pre_list_entry['children'] = list_entry
+            else:
+                pre_list_entry['children'] = [{'header': '',
+                                               'text': '',
+                                               'children': list_entry,
+                                               'text_type': u'ulist',
+                                               'tags': []}]
+
+            new_entries.append(pre_list_entry)
+
+            if post_list_entry['text'] or post_list_entry['children']:
+                new_entries.append(post_list_entry)
+
+            # rebuild the object by combining earlier content, re-inserted content, and later content
+            updated_obj = obj[:entry_counter] + new_entries + obj[entry_counter + 1:]
+            obj = updated_obj
+
+        # recursively apply assemble() to check for lists in children of the current object
+
+        if obj[entry_counter]['children']:
+            obj[entry_counter]['children'] = _assemble(obj[entry_counter]['children'], list_data)
+
+        entry_counter += 1
+
+    return obj
+
+
+def _format_ccp(obj, out=None, parent_index=0, offset=0, stubs=None, stub_path=None):
+    """
+    CCP format setup. Flattens the parsed object into rows, with document hierarchy expressed using integer parent/child
+    index columns.
+
+    :param obj: parsed object (or a list of top-level sections) to flatten.
+    :param out: rows created so far.
+    :param parent_index: index of the parent row.
+    :param offset: number of rows already written before obj, so that indices can continue across sections.
+    :param stubs: optionally, dictionary filled with header stub -> row indices, following the stub rules in
+        HierarchyManager.apply_tags.
+    :param stub_path: formatted headers leading to obj (used with stubs).
+    """
+
+    if not out:
+        out = []
+
+    for i in range(len(obj)):
+        entry = obj[i]
+
+        if entry['header']:
+            header_to_write = entry['header']
+        else:
+            header_to_write = ''
+
+        if stubs is not None:
+            if stub_path is None:
+                entry_path = [utils.format_header(entry['header'])]
+            elif entry['header']:
+                entry_path = stub_path + [utils.format_header(entry['header'])]
+            else:
+                entry_path = stub_path
+
+            if entry['text_type'] != 'body':
+                stubs['.'.join(h for h in entry_path if h)] = []
+        else:
+            entry_path = None
+
+        split_text = re.split('[\n\r]+', entry['text'])
+        for line in split_text:
+            current_index = offset + len(out) + 1
+
+            if entry['text_type'] != 'body' or line:
+                out.append([current_index, parent_index, header_to_write, '',
+                            entry['text_type'], line] + entry['tags'])
+
+                if stubs is not None and entry['text_type'] != 'body':
+                    stubs['.'.join(h for h in entry_path if h)].append(current_index)
+
+        if entry['children']:
+            out = _format_ccp(entry['children'], out, parent_index=offset + len(out), offset=offset, stubs=stubs,
+                              stub_path=entry_path)
+
+    return out
+
+
+def ccp_columns(width, output_format='ccp'):
+    """
+    Column names for CCP rows (see HierarchyManager.create_output): index, parent, header, reserved (always empty),
+    text_type, and text, followed by one column per tag (tag1, tag2, ...). Multilingual rows have three header columns
+    (header1 to header3) and three text columns (text1 to text3).
+
+    :param width: number of columns in the rows.
+    :param output_format: CCP format of the rows ('ccp' or 'ccp_multilingual').
+    """
+
+    if 'multilingual' in output_format:
+        columns = ['index', 'parent', 'header1', 'header2', 'header3', 'reserved', 'text_type', 'text1', 'text2',
+                   'text3']
+    else:
+        columns = ['index', 'parent', 'header', 'reserved', 'text_type', 'text']
+
+    return columns[:width] + ['tag{0}'.format(i + 1) for i in range(width - len(columns))]
+
+
+def _format_ccp_row(row, max_cols, output_format, string_indices=True):
+    """
+    Convert a row from _format_ccp() into its final CCP form: string indices (unless string_indices is False, e.g. for
+    sinks that store typed values), padded to max_cols, and with header and text columns replicated for multilingual
+    output.
+    """
+    if string_indices:
+        row = [str(row[0]), str(row[1])] + row[2:]
+    row += ['']*(max_cols - len(row))
+
+    if 'multilingual' in output_format:
+        row = row[0:2] + 3*[row[2]] + row[3:5] + 3*[row[5]] + row[6:]
+
+    return row
+
+
+def _clean_header(header):
+    """
+    Strip whitespace and punctuation not used for display from a matched header.
+    """
+    header = header.strip('\t\n\r ')
+    header = re.sub('[,|;^#*]', '', header)
+    header = re.sub('[-.:](?![A-Za-z0-9])', '', header)
+
+    return header
+
+
+def _compile_levels(header_regex, case_flags):
+    """
+    Compile the combined header patterns used by _Parser.detect_boundaries(): one for all levels, and one for the levels
+    below each level. Combining renumbers the groups of each pattern, so patterns with numbered backreferences (\\1,
+    (?(1)...)) are not combined, and neither are patterns whose group names clash. Returns (None, None) in that case,
+    and headers are then matched level by level.
+    """
+
+    if any(re.search(r'\\[1-9]|\(\?\([0-9]', h) for h in header_regex):
+        return None, None
+
+    try:
+        return (re.compile(_combine_levels(header_regex), case_flags),
+                [re.compile(_combine_levels(header_regex, i + 1), case_flags) if i + 1 < len(header_regex) else None
+                 for i in range(len(header_regex))])
+    except re.error:
+        return None, None
+
+
+def _combine_levels(header_regex, first_level=0):
+    """
+    Combine header regex into a single alternation, with one named group (level0, level1, ...) per level. Earlier
+    levels are tried first, so they take priority when several levels match at the same position.
+
+    :param header_regex: list of (line-anchored) header regex, from highest to lowest level.
+    :param first_level: index of the first level to include.
+    """
+
+    return u'|'.join(u'(?P<level{0}>{1})'.format(i, header_regex[i]) for i in range(first_level, len(header_regex)))
+
+
+def _format_diagnostics(report):
+    """
+    Format the output of _Parser.diagnose() as a plain-text table.
+    """
+
+    lines = ['level\tmatches\tseconds\tregex']
+    for level in report:
+        if level['superlinear']:
+            lines.append('{0}\t-\t-\t{1}\tSUPERLINEAR ({2})'.format(level['level'], level['regex'], level['probe']))
+        else:
+            lines.append('{0}\t{1}\t{2:.4f}\t{3}'.format(level['level'], level['matches'], level['seconds'],
+                                                         level['regex']))
+
+    return os.linesep.join(lines)
+
+
+def _index_stubs(stub_table):
+    """
+    Map every dot-separated suffix of each header stub to the stubs ending in it. A tag reference "75.4" then matches
+    "3.75.4" or "75.4" through a single dictionary lookup, rather than a regex scan over the full stub table.
+
+    :param stub_table: stub table, keyed by joined header stubs.
+    :return: dictionary of suffix -> list of matching stubs.
+    """
+    index = {}
+    for stub in stub_table:
+        components = stub.split('.')
+        for i in range(len(components)):
+            index.setdefault('.'.join(components[i:]), []).append(stub)
+
+    return index
+
+
 def clean_text(raw_text):
     """
     Simple text-cleaning function, which attempts to delete unnecessary whitespace.
@@ -0,0 +1,335 @@
+__author__ = 'rbshaffer'
+
+import os
+import csv
+import json
+import _file_utils as utils
+
+
+class Sink:
+    def __init__(self, buffer_size=1000):
+        """
+        Base class for output sinks. Rows are written to named tables (e.g. 'sections', 'failed_tags', 'skeleton') and
+        buffered per table, so that the underlying storage receives them in bulk. Writes are grouped by document: call
+        begin() before writing a document's tables and commit() once it is complete. Sinks can also be used as context
+        managers, which closes them on exit.
+
+        Subclasses implement _write_rows(), and optionally _begin(), _commit(), _rollback(), and _close().
+
+        :param buffer_size: number of rows to buffer per table before writing them out.
+        """
+
+        self.buffer_size = buffer_size
+        self.document = None
+
+        self._buffers = {}
+        self._columns = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.discard()
+        self.close()
+
+    def begin(self, document):
+        """
+        Start writing a document.
+
+        :param document: document name, used to label rows (or to name files, for file-based sinks).
+        """
+
+        if self.document is not None:
+            self.commit()
+
+        self.document = document
+        self._begin()
+
+    def write(self, table, rows, columns=None):
+        """
+        Buffer rows for a table, writing them out whenever the buffer is full.
+
+        :param table: table name.
+        :param rows: iterable of rows. Rows are sequences of values, or dictionaries if columns are given.
+        :param columns: optionally, column names. Only the first set of names given for a table in each document is
+            used. Unnamed values are named by position (c1, c2, ...).
+        """
+
+        if self.document is None:
+            raise Exception('No document started. Call begin() before writing.')
+
+        if table not in self._buffers:
+            self._buffers[table] = []
+            self._columns[table] = list(columns) if columns else []
+
+        buf = self._buffers[table]
+        columns = self._columns[table]
+
+        for row in rows:
+            if isinstance(row, dict):
+                row = [row.get(c, '') for c in columns]
+            buf.append(row)
+
+            if len(buf) >= self.buffer_size:
+                self._flush_table(table)
+
+    def flush(self):
+        """
+        Write out all buffered rows.
+        """
+
+        for table in self._buffers:
+            self._flush_table(table)
+
+    def commit(self):
+        """
+        Write out all buffered rows and finish the current document.
+        """
+
+        if self.document is None:
+            return
+
+        self.flush()
+        self._commit()
+
+        self.document = None
+        self._buffers = {}
+        self._columns = {}
+
+    def discard(self):
+        """
+        Drop buffered rows and abandon the current document. Rows already written out are rolled back by sinks that
+        implement _rollback(): file sinks delete the document's files, and SQLiteSink rolls back its transaction.
+        """
+
+        if self.document is None:
+            return
+
+        self._rollback()
+
+        self.document = None
+        self._buffers = {}
+        self._columns = {}
+
+    def close(self):
+        """
+        Commit the current document (if any) and release the underlying storage.
+        """
+
+        self.commit()
+        self._close()
+
+    def _flush_table(self, table):
+        buf = self._buffers[table]
+        if buf:
+            self._write_rows(table, self._columns[table], buf)
+            del buf[:]
+
+    def _begin(self):
+        pass
+
+    def _write_rows(self, table, columns, rows):
+        raise NotImplementedError
+
+    def _commit(self):
+        pass
+
+    def _rollback(self):
+        pass
+
+    def _close(self):
+        pass
+
+
+class _FileSink(Sink):
+    def __init__(self, paths, buffer_size=1000):
+        """
+        Shared setup for sinks writing one file per document and table. Files are opened on the first write to a
+        table, and closed when the document is committed. If the document is discarded, its files are deleted.
+
+        :param paths: dictionary of table name -> path template, formatted with the document name (e.g.
+            {'sections': '/path/to/{document}.csv'}). Tables without a path are not written.
+        :param buffer_size: number of rows to buffer per table before writing them out.
+        """
+
+        Sink.__init__(self, buffer_size)
+
+        self.paths = paths
+        self._files = {}
+
+    def _write_rows(self, table, columns, rows):
+        if table not in self.paths:
+            return
+
+        if table not in self._files:
+            self._files[table] = open(self.paths[table].format(document=self.document), 'wb')
+            self._open_table(table, columns)
+
+        self._write_file(table, columns, rows)
+
+    def _commit(self):
+        self._close_files()
+
+    def _rollback(self):
+        paths = [f.name for f in self._files.values()]
+        self._close_files()
+
+        for path in paths:
+            os.remove(path)
+
+    def _close(self):
+        self._close_files()
+
+    def _close_files(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+    def _open_table(self, table, columns):
+        pass
+
+    def _write_file(self, table, columns, rows):
+        raise NotImplementedError
+
+
+class CSVSink(_FileSink):
+    def __init__(self, paths, buffer_size=1000, headerless=()):
+        """
+        Write each table as a UTF-8 CSV file. A header row is written for tables with column names.
+
+        :param paths: dictionary of table name -> path template (see _FileSink).
+        :param buffer_size: number of rows to buffer per table before writing them out.
+        :param headerless: names of tables written without a header row, even if column names are given (e.g.
+            'sections', for plain CCP-style files).
+        """
+
+        _FileSink.__init__(self, paths, buffer_size)
+
+        self.headerless = headerless
+        self._writers = {}
+
+    def _open_table(self, table, columns):
+        self._writers[table] = csv.writer(self._files[table])
+        if columns and table not in self.headerless:
+            self._writers[table].writerow([utils._to_utf8(c) for c in columns])
+
+    def _write_file(self, table, columns, rows):
+        self._writers[table].writerows([[utils._to_utf8(v) for v in row] for row in rows])
+
+    def _close_files(self):
+        _FileSink._close_files(self)
+        self._writers = {}
+
+
+class JSONLinesSink(_FileSink):
+    """
+    Write each table as a UTF-8 JSON Lines file, with one object per row keyed by column name.
+    """
+
+    def _write_file(self, table, columns, rows):
+        lines = []
+        for row in rows:
+            names = _column_names(columns, len(row))
+            obj = dict(zip(names, [_to_unicode(v) for v in row]))
+            lines.append(json.dumps(obj, ensure_ascii=False, sort_keys=True).encode('utf-8'))
+
+        self._files[table].write('\n'.join(lines) + '\n')
+
+
+class SQLiteSink(Sink):
+    def __init__(self, db_path, buffer_size=1000):
+        """
+        Write tables to an SQLite database. Each table gets a leading 'document' column, and columns are added as
+        needed when wider rows arrive. Rows are inserted with executemany() inside a single transaction per document,
+        and all rows previously loaded for the same document are replaced.
+
+        :param db_path: path to the database file.
+        :param buffer_size: number of rows to buffer per table before inserting them.
+        """
+
+        import sqlite3
+
+        Sink.__init__(self, buffer_size)
+
+        # transactions are managed explicitly, so that added columns do not end a document's transaction early
+        self.connection = sqlite3.connect(db_path, isolation_level=None)
+
+        self._table_columns = {}
+
+    def _write_rows(self, table, columns, rows):
+        width = max(len(row) for row in rows)
+        names = ['document'] + _column_names(columns, width)
+
+        self._ensure_table(table, names)
+
+        query = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(_quote(table), ', '.join(_quote(n) for n in names),
+                                                           ', '.join('?'*len(names)))
+        document = _to_unicode(self.document)
+        padding = [None]*width
+
+        self.connection.executemany(query, [[document] + [_to_unicode(v) for v in row] + padding[len(row):]
+                                            for row in rows])
+
+    def _begin(self):
+        self.connection.execute('BEGIN')
+
+        tables = [row[0] for row in self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        for table in tables:
+            self._ensure_table(table, [])
+            if 'document' in self._table_columns[table]:
+                self.connection.execute('DELETE FROM {0} WHERE document = ?'.format(_quote(table)),
+                                        (_to_unicode(self.document),))
+
+    def _commit(self):
+        self.connection.execute('COMMIT')
+
+    def _rollback(self):
+        self.connection.execute('ROLLBACK')
+        # columns added in the rolled-back transaction are gone as well
+        self._table_columns = {}
+
+    def _close(self):
+        self.connection.close()
+
+    def _ensure_table(self, table, names):
+        """
+        Create the table, or add any columns it does not have yet.
+        """
+
+        if table not in self._table_columns:
+            existing = [row[1] for row in self.connection.execute('PRAGMA table_info({0})'.format(_quote(table)))]
+            if not existing:
+                self.connection.execute('CREATE TABLE {0} ({1})'.format(_quote(table),
+                                                                      ', '.join(_quote(n) for n in names)))
+                existing = list(names)
+            self._table_columns[table] = existing
+
+            # _begin() replaces a document's rows, so lookups by document must not scan the whole table
+            if 'document' in existing:
+                self.connection.execute('CREATE INDEX IF NOT EXISTS {0} ON {1} (document)'.format(
+                    _quote(table + '_document'), _quote(table)))
+
+        existing = self._table_columns[table]
+        for name in names:
+            if name not in existing:
+                self.connection.execute('ALTER TABLE {0} ADD COLUMN {1}'.format(_quote(table), _quote(name)))
+                existing.append(name)
+
+
+def _column_names(columns, width):
+    """
+    Pad column names to the given row width, naming unnamed columns c1, c2, ... by position.
+    """
+
+    return list(columns[:width]) + ['c{0}'.format(i + 1) for i in range(len(columns), width)]
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _to_unicode(s):
+    if isinstance(s, str):
+        return s.decode('utf-8')
+    return s
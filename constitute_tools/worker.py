@@ -0,0 +1,121 @@
+"""
+Long-lived worker for batch tabulation. Jobs are read as JSON objects (one per line) from stdin or from a local Unix
+socket, and run through wrappers.Tabulator in a single process, so that imports, compiled header patterns, and
+normalization tables stay warm across documents.
+
+Each job gives a working directory, a text path, and header regex, plus any other Tabulator.tabulate() arguments:
+
+    {"working_directory": "/path/to/working_dir", "text_path": "/path/to/cleaned.txt",
+     "header_regex": ["Article [0-9]+"]}
+
+One JSON result is written back per job, with "status" set to "ok" or "error".
+
+Usage: python -m constitute_tools.worker [--socket PATH]
+"""
+
+import sys
+import json
+import time
+import traceback
+
+from constitute_tools import wrappers
+
+
+def run_job(job):
+    """
+    Run a single tabulation job.
+
+    :param job: dictionary with working_directory, text_path, and header_regex keys, plus any optional arguments to
+        Tabulator.tabulate().
+    :return: result dictionary.
+    """
+
+    job = dict(job)
+    start = time.time()
+
+    try:
+        # header regex are expected as UTF-8 byte strings
+        header_regex = [h.encode('utf-8') if isinstance(h, unicode) else h for h in job.pop('header_regex')]
+
+        tabulator = wrappers.Tabulator(job.pop('working_directory'))
+        tabulator.tabulate(job.pop('text_path'), header_regex, **job)
+
+        result = {'status': 'ok'}
+    except Exception as e:
+        result = {'status': 'error', 'error': repr(e), 'traceback': traceback.format_exc()}
+
+    result['seconds'] = time.time() - start
+
+    return result
+
+
+def serve(in_stream, out_stream):
+    """
+    Read jobs from in_stream and write results to out_stream until in_stream is exhausted. Progress messages printed
+    while jobs run are sent to stderr, so that out_stream only carries results.
+    """
+
+    stdout = sys.stdout
+
+    for line in iter(in_stream.readline, ''):
+        if not line.strip():
+            continue
+
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise ValueError('expected a JSON object, got ' + repr(job))
+        except ValueError as e:
+            result = {'status': 'error', 'error': 'Invalid job: ' + repr(e)}
+        else:
+            sys.stdout = sys.stderr
+            try:
+                result = run_job(job)
+            finally:
+                sys.stdout = stdout
+
+            result['text_path'] = job.get('text_path')
+
+        out_stream.write(json.dumps(result) + '\n')
+        out_stream.flush()
+
+
+def serve_socket(path):
+    """
+    Serve jobs over a local Unix socket at path. Each connection sends one or more jobs and receives one result per job.
+    Connections are handled one at a time.
+    """
+
+    import os
+    import stat
+    import SocketServer
+
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            serve(self.rfile, self.wfile)
+
+    # replace a stale socket left by an earlier worker, but never another kind of file
+    if os.path.lexists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise Exception('{0} exists and is not a socket. Choose another socket path.'.format(path))
+        os.remove(path)
+
+    server = SocketServer.UnixStreamServer(path, Handler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def main(args):
+    if len(args) == 2 and args[0] == '--socket':
+        serve_socket(args[1])
+    elif not args:
+        serve(sys.stdin, sys.stdout)
+    else:
+        sys.exit(__doc__)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
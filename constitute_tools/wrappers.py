@@ -2,23 +2,37 @@ __author__ = 'rbshaffer'
 
 import os
 import re
-import csv
 import codecs
+import diff
+import sinks
 import parser
 import _file_utils as utils
 
 
 class Tabulator:
-    def __init__(self, working_directory):
+    def __init__(self, working_directory, sink=None):
         """
         Wrapper class, which provides an easy interface to manage paths and outputs created by Segmenter.
 
         :param working_directory: working directory to use (with or without preexisting file structure)
+        :param sink: optionally, a sinks.Sink receiving the tabulated rows ('sections'), failed tags ('failed_tags'),
+            and skeleton ('skeleton') of each document. Sections are written with CCP column names (see
+            parser.ccp_columns). By default, sections (without a header row) and failed tags are written as CSV files in
+            Tabulated_Texts and Reports.
         """
 
         self.pwd = working_directory
         self.set_structure()
 
+        if sink is None:
+            # sink paths are templates, so braces in the working directory are escaped
+            pwd = self.pwd.replace('{', '{{').replace('}', '}}')
+            paths = {'sections': '{1}{0}Constitute{0}Tabulated_Texts{0}{{document}}.csv'.format(os.sep, pwd),
+                     'failed_tags': '{1}{0}Constitute{0}Reports{0}{{document}}_failed_tags.csv'.format(os.sep, pwd)}
+            sink = sinks.CSVSink(paths, headerless=['sections'])
+
+        self.sink = sink
+
     def clean_text(self, text_path):
         """
         Wrapper for clean_text function in segmenter. Output placed in Cleaned_Texts folder.
@@ -37,52 +51,75 @@ class Tabulator:
             f.write(cleaned)
 
     def tabulate(self, text_path, header_regex, preamble_level=0, case_sensitive=False, tag_format='ccp',
-                 writer_format='ccp'):
+                 writer_format='ccp', time_budget=None, low_memory=False):
         """
-        Wrapper function for hierarchical parser contained in segmenter. Outputs placed in Tabulated_Texts and Reports.
-        Tag data assumed to be contained in the Article_Numbers folder, with the same base name as the document to be
-        parsed.
+        Wrapper function for hierarchical parser contained in segmenter. Tables are written to the Tabulator's sink, and
+        reports are placed in Reports (including a structural fingerprint, which can be compared against later versions
+        with diff.diff()). Tag data assumed to be contained in the Article_Numbers folder, with the same base name as
+        the document to be parsed.
 
         :param text_path: path to text to be segmented.
         :param header_regex: regular expressions to use for segmentation.
         :param preamble_level: highest-level parameter immediately following the end of the preamble.
         :param case_sensitive: if True, hierarchical tag searches are case-sensitive.
         :param tag_format: format for content tags.
-        :param writer_format: format for data output.
+        :param writer_format: format for data output. 'columnar' writes a binary .ccp table instead of a CSV.
+        :param time_budget: optionally, maximum number of seconds to spend segmenting the document.
+        :param low_memory: if True, the document is segmented one top-level section at a time and CCP rows are
+            streamed to the sink (see HierarchyManager.stream_output). Not available with the columnar writer format.
         """
 
         # format paths and generate output
         file_name = os.path.basename(text_path)
         file_name = re.sub('\..*', '', file_name)
 
-        out_path = '{1}{0}Constitute{0}Tabulated_Texts{0}{2}.csv'.format(os.sep, self.pwd, file_name)
-        tag_report_path = '{1}{0}Constitute{0}Reports{0}{2}_failed_tags.csv'.format(os.sep, self.pwd, file_name)
+        out_path = '{1}{0}Constitute{0}Tabulated_Texts{0}{2}.ccp'.format(os.sep, self.pwd, file_name)
         skeleton_path = '{1}{0}Constitute{0}Reports{0}{2}_skeleton.txt'.format(os.sep, self.pwd, file_name)
+        fingerprint_path = '{1}{0}Constitute{0}Reports{0}{2}_fingerprint.json'.format(os.sep, self.pwd, file_name)
         tag_path = '{1}{0}Constitute{0}Article_Numbers{0}{2}.csv'.format(os.sep, self.pwd, file_name)
 
         manager = parser.HierarchyManager(text_path=text_path, header_regex=header_regex,
                                           preamble_level=preamble_level, case_sensitive=case_sensitive,
-                                          tag_format=tag_format, tag_path=tag_path)
-        manager.parse()
-        manager.apply_tags()
-        out = manager.create_output(output_format=writer_format)
-
-        # write output and generate reports
-        with open(out_path, 'wb') as f:
-            utils.UnicodeWriter(f).writerows(out)
+                                          tag_format=tag_format, tag_path=tag_path, time_budget=time_budget,
+                                          low_memory=low_memory)
 
-        if manager.tag_data:
-            with open(tag_report_path, 'wb') as f:
-                var_names = sorted(manager.tag_report[0].keys())
+        if low_memory and writer_format == 'columnar':
+            raise Exception('The columnar writer format is not available in low-memory mode.')
 
-                writer = csv.DictWriter(f, var_names)
-                writer.writeheader()
-                writer.writerows(manager.tag_report)
+        # write output and generate reports
+        self.sink.begin(file_name)
+        try:
+            if low_memory:
+                manager.stream_output(self.sink, output_format=writer_format)
+            else:
+                manager.parse()
+                manager.apply_tags()
+                out = manager.create_output(output_format=writer_format)
+
+                if writer_format == 'columnar':
+                    out.write(out_path)
+                else:
+                    # sinks get integer index and parent columns, so that typed sinks store and sort them as numbers
+                    rows = ([int(row[0]), int(row[1])] + row[2:] for row in out)
+                    self.sink.write('sections', rows, columns=parser.ccp_columns(len(out[0]) if out else 0,
+                                                                                 writer_format))
+
+            if manager.tag_report:
+                self.sink.write('failed_tags', manager.tag_report, columns=sorted(manager.tag_report[0].keys()))
+
+            self.sink.write('skeleton', diff.outline(manager.fingerprint), columns=['depth', 'header'])
+        except Exception:
+            self.sink.discard()
+            raise
+
+        self.sink.commit()
 
         with codecs.open(skeleton_path, 'wb', encoding='utf8') as f:
             f.write(repr(header_regex) + os.linesep)
             f.write(''.join(manager.skeleton))
 
+        diff.dump(manager.fingerprint, fingerprint_path)
+
     def set_structure(self):
         """
         Helper function to create the file structure assumed to be present for the rest of this wrapper. If folders are